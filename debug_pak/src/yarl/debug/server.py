@@ -42,10 +42,11 @@ class PackagedRequestHandler(BaseHTTPRequestHandler):
         logger.debug("Resource: %s", resource_name)
         if package.contains(resource_name, PackageIndex.RESOURCE):
             logger.debug("Sending resource")
-            handle, meta = package.read(resource_name, PackageIndex.RESOURCE)
             self.send_response(200, "OK")
+            self.send_header("Content-Length", str(package.size(resource_name, PackageIndex.RESOURCE)))
             self.end_headers()
-            self.wfile.write(handle)
+            for chunk in package.stream(resource_name, PackageIndex.RESOURCE):
+                self.wfile.write(chunk)
         else:
             logger.debug("Resource not found")
             self.send_error(404, "Resource Not Found")
@@ -3,19 +3,42 @@ import logging
 import sys
 from yarl.package import PackageManifest
 
-args_parser = argparse.ArgumentParser(description="Builds the asset bundle")
-args_parser.add_argument('manifest',
-                         help="Package manifest (see documentation)")
-args_parser.add_argument('--name',
-                         dest='name',
-                         default='package.zip',
-                         help="Target archive name")
-args = args_parser.parse_args()
+# Guarded, the build workers import this module when processes are spawned
+if __name__ == '__main__':
+    args_parser = argparse.ArgumentParser(description="Builds the asset bundle")
+    args_parser.add_argument('manifest',
+                             help="Package manifest (see documentation)")
+    args_parser.add_argument('--name',
+                             dest='name',
+                             default='package.zip',
+                             help="Target archive name")
+    args_parser.add_argument('--bytecode',
+                             dest='bytecode',
+                             action='store_true',
+                             help="Store compiled modules in the archive")
+    args_parser.add_argument('--optimize-png',
+                             dest='optimize_png',
+                             action='store_true',
+                             help="Recompress tileset images")
+    args_parser.add_argument('--jobs',
+                             dest='jobs',
+                             type=int,
+                             default=None,
+                             help="Number of build processes (0 builds in the main process)")
+    args_parser.add_argument('--full',
+                             dest='incremental',
+                             action='store_false',
+                             help="Rebuild every member instead of reusing unchanged ones")
+    args = args_parser.parse_args()
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s %(message)s',
-                    datefmt='%I:%M:%S',
-                    stream=sys.stdout)
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(message)s',
+                        datefmt='%I:%M:%S',
+                        stream=sys.stdout)
 
-manifest = PackageManifest(args.manifest)
-manifest.build_archive(args.name)
+    manifest = PackageManifest(args.manifest)
+    manifest.build_archive(args.name,
+                           bytecode=args.bytecode,
+                           optimize_png=args.optimize_png,
+                           workers=args.jobs,
+                           incremental=args.incremental)
@@ -0,0 +1,47 @@
+import timeit
+from yarl.util import cantor_pairing, pack_key, unpack_key
+
+radius = 64
+repeat = 5
+
+coords = [(x, y) for x in range(-radius, radius) for y in range(-radius, radius)]
+
+print("Checking keys ...")
+cantor_keys = set(cantor_pairing(x, y) for x, y in coords)
+packed_keys = set(pack_key(x, y) for x, y in coords)
+print("cantor_pairing: %i distinct keys for %i chunks" % (len(cantor_keys), len(coords)))
+print("pack_key:       %i distinct keys for %i chunks" % (len(packed_keys), len(coords)))
+assert all(unpack_key(pack_key(x, y)) == (x, y) for x, y in coords)
+
+# Far away chunks run out of float precision with cantor pairing
+far = [(1 << 27, 1 << 27), ((1 << 27) + 1, (1 << 27) - 1)]
+print("cantor_pairing collides far away: %s" % (cantor_pairing(*far[0]) == cantor_pairing(*far[1])))
+print("pack_key collides far away:       %s" % (pack_key(*far[0]) == pack_key(*far[1])))
+
+
+def bench(name, key_func):
+    pool = {key_func(x, y): (x, y) for x, y in coords}
+
+    def make_keys():
+        for x, y in coords:
+            key_func(x, y)
+
+    def lookup():
+        for x, y in coords:
+            pool[key_func(x, y)]
+
+    keys = list(pool.keys())
+
+    def lookup_keys():
+        for key in keys:
+            pool[key]
+
+    for label, func in (("key", make_keys), ("key + lookup", lookup), ("lookup", lookup_keys)):
+        best = min(timeit.repeat(func, number=10, repeat=repeat))
+        rate = len(coords) * 10 / best
+        print("%-16s %-14s %8.2f Mops/s" % (name, label, rate / 1e6))
+
+
+print("Benchmarking ...")
+bench("cantor_pairing", cantor_pairing)
+bench("pack_key", pack_key)
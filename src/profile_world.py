@@ -0,0 +1,172 @@
+import argparse
+import cProfile
+import pstats
+import io
+import os
+import time
+import numpy as np
+from sfml import sf
+from yarl.map.chunk import Chunk, TileMatrix
+from yarl.block import *
+from yarl.asset import AssetLoader, TexturePool
+from yarl.message import MessageBus
+from yarl.package import PackageLoader
+from yarl.service import Container, Service
+from yarl.view import TileMap, TileAtlas
+from yarl.save import SaveFile
+
+# Named so it does not shadow the standard `profile` module that cProfile imports
+args_parser = argparse.ArgumentParser(description="Profiles world building and measures the save file codecs")
+args_parser.add_argument('--render',
+                         dest='render',
+                         action='store_true',
+                         help="Also profile the tile map, needs the packages providing the block icons")
+args_parser.add_argument('--load',
+                         dest='paks',
+                         nargs='*',
+                         default=[],
+                         help="Packages loaded for --render")
+args = args_parser.parse_args()
+
+world_name = "profiler"
+
+profiler = cProfile.Profile()
+
+container = Container.get()
+container.add_factory('engine.block_registry', BlockRegistry)
+container.add_factory('engine.message_bus', MessageBus)
+
+print("Loading Blocks ...")
+registry = BlockRegistry.instance()
+registry.add(VoidBlock)
+registry.add(FloorBlock)
+registry.add(WallBlock)
+
+tile_atlas = None
+if args.render:
+    print("Loading Textures ...")
+    package_loader = PackageLoader(args.paks)
+    package_loader.load()
+    container.add_instance('engine.package_loader', package_loader)
+    container.add_factory('engine.asset_loader', AssetLoader)
+    container.add_factory('engine.texture_pool', TexturePool)
+
+    tile_atlas = TileAtlas(tex_pool=Service.get('engine.texture_pool'),
+                           size=sf.Vector2(16, 16),
+                           order=16)
+    tile_atlas.build(registry)
+
+print("Loading World ...")
+profiler.enable()
+
+save_file = SaveFile(world_name, 0)
+save_file.open()
+save_file.clear(world_name)
+
+save_file.load()
+
+world = save_file.world
+region = world.region("Hub Town")
+level = region.level("Ground")
+
+print("Building World ...")
+p2 = sf.Vector2(level.size.x // 2, level.size.y // 2) * Chunk.size
+p1 = -p2
+level.fill_rect(p1, p2 - p1, registry.get("block.floor"))
+
+print("Saving ...")
+save_file.save()
+print("Done!")
+
+if tile_atlas is not None:
+    tile_map = TileMap(size=sf.Vector2(9, 9),
+                       atlas=tile_atlas)
+    tile_map.update(level, sf.Vector2(0, 0))
+
+profiler.disable()
+save_file.close()
+
+s = io.StringIO()
+sortby = 'cumulative'
+ps = pstats.Stats(profiler, stream=s).sort_stats(sortby)
+ps.print_stats(20)
+print(s.getvalue())
+
+print("Measuring chunk codecs ...")
+
+
+def measure_codec(version):
+    TileMatrix.write_version = version
+    path = "%s-v%i" % (world_name, version)
+
+    codec_file = SaveFile(path, 0, max_chunks=None)
+    codec_file.open()
+    codec_file.clear(world_name)
+    codec_file.load()
+    codec_level = codec_file.world.region("Hub Town").level("Ground")
+    codec_level.fill_rect(p1, p2 - p1, registry.get("block.floor"))
+
+    start = time.perf_counter()
+    chunks = codec_file.save()
+    save_time = time.perf_counter() - start
+    codec_file.close()
+
+    codec_file = SaveFile(path, 0, max_chunks=None)
+    codec_file.open()
+    codec_file.load()
+    codec_level = codec_file.world.region("Hub Town").level("Ground")
+
+    start = time.perf_counter()
+    codec_level.prefetch_rect(p1, p2 - p1)
+    load_time = time.perf_counter() - start
+    codec_file.close()
+
+    print("v%i: %i chunks, %i bytes, save %.1fms, load %.1fms" % (version, chunks, os.path.getsize(path),
+                                                                   save_time * 1000, load_time * 1000))
+
+
+measure_codec(1)
+measure_codec(TileMatrix.version)
+
+print("Measuring entities ...")
+
+
+def measure_entities(count, queries=1000):
+    path = "%s-entities" % world_name
+
+    entity_file = SaveFile(path, 0, max_chunks=None)
+    entity_file.open()
+    entity_file.clear(world_name)
+    entity_file.load()
+    entity_level = entity_file.world.region("Hub Town").level("Ground")
+    entity_level.prefetch_rect(p1, p2 - p1)
+
+    xs = np.random.uniform(p1.x, p2.x, count)
+    ys = np.random.uniform(p1.y, p2.y, count)
+    start = time.perf_counter()
+    for x, y in zip(xs.tolist(), ys.tolist()):
+        entity_level.entities.spawn("entity.mob", x, y)
+    spawn_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    found = 0
+    for x, y in zip(xs[:queries].tolist(), ys[:queries].tolist()):
+        found += len(entity_level.entities.query_radius(x, y, 8))
+    query_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for x, y in zip(xs[:queries].tolist(), ys[:queries].tolist()):
+        entity_level.entities.nearest(x + 0.5, y + 0.5)
+    nearest_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    entity_file.save()
+    save_time = time.perf_counter() - start
+    entity_file.close()
+
+    print("%i entities: spawn %.1fms, %i radius queries %.1fms (%i found), %i nearest %.1fms, save %.1fms, %i bytes"
+          % (count, spawn_time * 1000, queries, query_time * 1000, found, queries, nearest_time * 1000,
+             save_time * 1000, os.path.getsize(path)))
+
+
+measure_entities(10000)
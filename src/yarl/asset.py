@@ -1,43 +1,130 @@
-import tarfile as tar
-# from sfml import sf
-from os.path import basename
+from collections import OrderedDict
+from yarl.package import PackageIndex
 from yarl.service import Inject
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 @Inject(loader='engine.package_loader')
 class AssetLoader(object):
+    """
+    Resolves asset files through the merged index of the package loader
+    Tilesets take precedence over resources of the same name
+    """
+
+    kinds = (PackageIndex.TILESET, PackageIndex.RESOURCE)
+
     def __init__(self, loader):
         self.loader = loader
+        # Maps a file name to its index category, filled on first lookup
+        self.kind_map = dict()
 
-    def load(self):
-        for file in self.repo_files:
-            print("Loading repository %s" % file)
-            name = basename(file)
-            self.repo_tar[name] = tar.open(file, mode='r:gz')
+    def locate(self, file):
+        kind = self.kind_map.get(file)
+        if kind is None:
+            for kind in self.kinds:
+                if self.loader.contains(file, kind):
+                    break
+            else:
+                raise KeyError("File not found %s in packages" % file)
 
-    def get_file(self, file):
-        for name in self.repo_tar:
-            try:
-                repo = self.repo_tar[name]
-                member = repo.getmember(file)
-                reader = repo.extractfile(member)
-                return reader.read()
-            except KeyError:
-                # Discard not found exception for individual repositories
-                pass
+            self.kind_map[file] = kind
+
+        return kind
 
-        raise KeyError("File not found %s in asset repositories" % file)
+    def contains(self, file):
+        try:
+            self.locate(file)
+            return True
+        except KeyError:
+            return False
+
+    def get_file(self, file):
+        """
+        Returns a read-only view of the file, mapped from its package when possible
+        """
+        data, meta = self.loader.view(file, self.locate(file))
+        return data
 
 
+@Inject(provider='engine.asset_loader')
 class TexturePool(object):
-    def __init__(self, provider):
+    """
+    Decodes each texture once and keeps them in least-recently-used order
+    When over budget, textures that are not pinned (by the current `TileAtlas`) are evicted
+    """
+
+    def __init__(self, provider, max_bytes=64 * 1024 * 1024):
         self.provider = provider
-        self.textures = dict()
+        self.max_bytes = max_bytes
+        self.textures = OrderedDict()
+        self.sizes = dict()
+        self.pinned = set()
+        self.nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return "TexturePool{ textures=%i, bytes=%i }" % (len(self.textures), self.nbytes)
 
     def get(self, name):
-        if name not in self.textures:
-            data = self.provider.get_file(name)
-            image = sf.Image.from_memory(data)
-            self.textures[name] = sf.Texture.from_image(image)
+        texture = self.textures.get(name)
+        if texture is not None:
+            self.hits += 1
+            self.textures.move_to_end(name)
+            return texture
+
+        self.misses += 1
+        texture = self.decode(name)
+        size = texture.size
+        self.textures[name] = texture
+        self.sizes[name] = int(size.x) * int(size.y) * 4
+        self.nbytes += self.sizes[name]
+        self.purge()
+
+        return texture
+
+    def decode(self, name):
+        from sfml import sf
+
+        logger.debug("Decoding texture %s", name)
+        image = sf.Image.from_memory(bytes(self.provider.get_file(name)))
+        return sf.Texture.from_image(image)
+
+    def pin(self, names):
+        """
+        Protects the given textures from eviction, replaces the previously pinned set
+        """
+        self.pinned = set(names)
+
+    def stats(self):
+        return dict(textures=len(self.textures), bytes=self.nbytes, pinned=len(self.pinned),
+                    hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+    def over_budget(self):
+        return self.max_bytes is not None and self.nbytes > self.max_bytes
+
+    def purge(self):
+        """
+        Evicts the least recently used textures until the pool fits in its budget
+        The most recently used texture and the pinned ones are never evicted
+        """
+        if not self.over_budget():
+            return
+
+        victims = [name for name in itertools.islice(self.textures, len(self.textures) - 1)
+                   if name not in self.pinned]
+        for name in victims:
+            if not self.over_budget():
+                break
+
+            self.evict(name)
 
-        return self.textures[name]
+    def evict(self, name):
+        del self.textures[name]
+        self.nbytes -= self.sizes.pop(name)
+        self.evictions += 1
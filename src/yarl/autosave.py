@@ -0,0 +1,92 @@
+from threading import Thread
+from queue import Queue
+from yarl.schema import WorldTable, RegionTable, LevelTable, ChunkTable
+import logging
+import copy
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SaveSnapshot(object):
+    """
+    Detached copy of the rows an asynchronous save writes
+    Taken on the game thread, only read by the writer afterwards
+    """
+
+    def __init__(self, world):
+        self.worlds = [copy.copy(world)]
+        self.regions = list()
+        self.levels = list()
+        # Pairs of (live level, chunk copies), the live level is only used back on the game thread
+        self.chunks = list()
+
+        self.error = None
+        self.elapsed = None
+
+        for region in world.regions.values():
+            self.regions.append(copy.copy(region))
+            for level in region.levels.values():
+                row, chunks = level.snapshot()
+                self.levels.append(row)
+                self.chunks.append((level, chunks))
+
+    def __repr__(self):
+        return "SaveSnapshot{ levels=%i, chunks=%i }" % (len(self.levels), self.chunk_count)
+
+    @property
+    def chunk_count(self):
+        return sum(len(chunks) for level, chunks in self.chunks)
+
+    def write(self, conn):
+        WorldTable(conn).upsert_many(self.worlds)
+        RegionTable(conn).upsert_many(self.regions)
+        LevelTable(conn).upsert_many(self.levels)
+        for level, chunks in self.chunks:
+            ChunkTable(conn).upsert_many(chunks)
+
+    def release(self):
+        """
+        Gives the chunks back to their loaders once the snapshot is written or has failed
+        """
+        for level, chunks in self.chunks:
+            level.saved(chunks, failed=self.error is not None)
+
+
+class SaveWriter(Thread):
+    """
+    Writes snapshots on a background thread with its own connection
+    Finished snapshots are handed back through `results`, the game thread polls it
+    """
+
+    def __init__(self, save_file):
+        super().__init__(daemon=True)
+        self.save_file = save_file
+        self.requests = Queue()
+        self.results = Queue()
+
+    def request(self, snapshot):
+        self.requests.put(snapshot)
+
+    def stop(self):
+        self.requests.put(None)
+
+    def run(self):
+        conn = self.save_file.connect()
+        while True:
+            snapshot = self.requests.get()
+            if snapshot is None:
+                break
+
+            start = time.perf_counter()
+            try:
+                snapshot.write(conn)
+            except Exception as e:
+                # Any failure is reported, the game thread would otherwise wait forever
+                logger.exception("Failed to write %s", snapshot)
+                snapshot.error = e
+
+            snapshot.elapsed = time.perf_counter() - start
+            self.results.put(snapshot)
+
+        conn.close()
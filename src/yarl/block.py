@@ -1,14 +1,29 @@
+from yarl.service import Service
+import numpy as np
+
+
 class BlockRegistry(object):
     """
     Registry of all block types
     """
 
+    @staticmethod
+    def instance():
+        """
+        Registry of the running engine, the `engine.block_registry` service
+        """
+        return Service.get('engine.block_registry')
+
     def __init__(self):
         self.id_map = None
+        self.name_map = dict()
+        self.id_blocks = list()
         self.blocks = dict()
 
     def add(self, klass):
         self.blocks[klass.name] = klass()
+        if self.id_map is not None and klass.name in self.name_map:
+            self.id_blocks[self.name_map[klass.name]] = self.blocks[klass.name]
 
     def get(self, name):
         if name in self.blocks:
@@ -17,11 +32,33 @@ class BlockRegistry(object):
             raise KeyError("Block %s does not exist" % name)
 
     def build_map(self):
-        next_key = 0
-        self.id_map = dict()
-        for name in self.blocks:
-            self.id_map[next_key] = name
-            next_key += 1
+        """
+        Assigns ids to the registered blocks that do not have one yet
+        Ids already in the map are never renumbered, `block.void` gets id 0 in a new map
+        Returns the number of assigned ids
+        """
+        if self.id_map is None:
+            self.id_map = dict()
+
+        names = sorted(self.blocks, key=lambda name: name != 'block.void')
+        added = 0
+        for name in names:
+            if name not in self.name_map:
+                next_key = 0 if len(self.id_map) == 0 else max(self.id_map) + 1
+                self.id_map[next_key] = name
+                added += 1
+
+        self.index_map()
+        return added
+
+    def index_map(self):
+        """
+        Builds the reverse and dense mappings of the id map
+        """
+        self.name_map = {name: block_id for block_id, name in self.id_map.items()}
+        self.id_blocks = [None] * (max(self.id_map) + 1 if len(self.id_map) > 0 else 0)
+        for block_id, name in self.id_map.items():
+            self.id_blocks[block_id] = self.blocks.get(name)
 
     def save_map(self):
         # Packs a tuple
@@ -38,27 +75,50 @@ class BlockRegistry(object):
             key, val = pair.split(':')
             self.id_map[int(key)] = val
 
+        self.index_map()
+
     def get_block_id(self, block):
-        name = type(block).name
-        res = [blk_id for blk_id, blk_name in self.id_map.items() if blk_name == name]
-        if len(res) > 0:
-            return res[0]
-        else:
-            return None
+        return self.name_map.get(block.name)
+
+    def compile_icons(self):
+        """
+        Builds the dense table of icon cells indexed by block id and variant index
+        Variants of a block are indexed in the order its icons were registered
+        Returns the blocks indexed by id, the table and whether each block renders dynamically
+        """
+        blocks = list(self.id_blocks)
+        size = len(blocks)
+
+        width = max([len(block.icons) for block in blocks if block is not None] + [1])
+        cells = np.zeros((size, width), dtype=np.int32)
+        dynamic = np.zeros(size, dtype=bool)
+        for block_id, block in enumerate(blocks):
+            if block is not None:
+                cells[block_id, :len(block.icons)] = list(block.icons.values())
+                dynamic[block_id] = block.dynamic
+
+        return blocks, cells, dynamic
 
     def from_id(self, block_id):
-        if int(block_id) in self.id_map:
-            name = self.id_map[int(block_id)]
-            return self.blocks[name]
-        else:
+        try:
+            block = self.id_blocks[block_id]
+        except IndexError:
+            block = None
+
+        if block is None:
             raise KeyError("Cannot find block with ID %s" % block_id)
 
+        return block
+
 
 class Block(object):
     """
     Base Block Interface
     """
 
+    # Dynamic blocks are rendered by calling `render` for each tile instead of using the render table
+    dynamic = False
+
     def __init__(self):
         self.icons = dict()
 
@@ -70,8 +130,17 @@ class Block(object):
         """
         pass
 
-    def render(self, meta, vertices):
-        raise NotImplemented("Method 'render' must be implemented")
+    def variant(self, meta):
+        """
+        Name of the icon used to render a tile with metadata
+        """
+        return 'default'
+
+    def render(self, meta, quad):
+        """
+        Sets the icon of a tile, only called for dynamic blocks
+        """
+        quad.set_icon(self.icons[self.variant(meta)])
 
 
 class VoidBlock(Block):
@@ -80,9 +149,6 @@ class VoidBlock(Block):
     def register_icons(self, registry):
         self.icons['default'] = registry.add_icon('1:1:objects/Floor.png')
 
-    def render(self, meta, quad):
-        quad.set_icon(self.icons['default'])
-
 
 class FloorBlock(Block):
     name = "block.floor"
@@ -90,15 +156,9 @@ class FloorBlock(Block):
     def register_icons(self, registry):
         self.icons['default'] = registry.add_icon('15:4:objects/Floor.png')
 
-    def render(self, meta, quad):
-        quad.set_icon(self.icons['default'])
-
 
 class WallBlock(Block):
     name = "block.wall"
 
     def register_icons(self, registry):
         self.icons['default'] = registry.add_icon('3:3:objects/Floor.png')
-
-    def render(self, meta, quad):
-        quad.set_icon(self.icons['default'])
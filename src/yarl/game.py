@@ -1,4 +1,4 @@
-from yarl.asset import AssetLoader
+from yarl.asset import AssetLoader, TexturePool
 from yarl.block import BlockRegistry
 from yarl.message import MessageBus
 from yarl.package import PackageLoader, PackageIndex
@@ -19,16 +19,15 @@ class GameBootstrap(object):
         self.loaders = list()
 
     def load(self):
-        for name, package in self.package_loader.packages.items():
-            for _, (loaders, meta) in package.index.get_all(PackageIndex.LOADER):
-                # base_package = meta['base_package']
-                for loader in loaders:
-                    module_name, class_name = loader.rsplit('.', 1)
-                    logger.debug("Importing %s", module_name)
-                    module = importlib.import_module(module_name)
-                    loader_class = getattr(module, class_name)
-                    loader_instance = loader_class()
-                    self.loaders.append(loader_instance)
+        for _, (loaders, meta) in self.package_loader.get_all(PackageIndex.LOADER):
+            # base_package = meta['base_package']
+            for loader in loaders:
+                module_name, class_name = loader.rsplit('.', 1)
+                logger.debug("Importing %s", module_name)
+                module = importlib.import_module(module_name)
+                loader_class = getattr(module, class_name)
+                loader_instance = loader_class()
+                self.loaders.append(loader_instance)
 
         logger.info("pre_init phase")
         apply_seq(self.loaders, 'pre_init')
@@ -83,6 +82,7 @@ class Game(object):
 
         container.add_instance('engine.package_loader', package_loader)
         container.add_factory('engine.asset_loader', AssetLoader)
+        container.add_factory('engine.texture_pool', TexturePool)
         container.add_factory('engine.block_registry', BlockRegistry)
         container.add_factory('engine.thread_runner', ThreadRunner)
         container.add_factory('engine.scene_graph', SceneGraph)
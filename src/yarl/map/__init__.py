@@ -1,6 +1,11 @@
-from yarl.map.chunk import ChunkLoader, ChunkTree
+from yarl.map.chunk import ChunkLoader, ChunkIndex, Chunk
+from yarl.map.entity import EntityStore
 from yarl.schema import RegionTable, LevelTable, WorldTable
+from yarl.block import BlockRegistry
 from sfml import sf
+import numpy as np
+import copy
+import math
 
 
 class World(object):
@@ -79,23 +84,48 @@ class Level(object):
         self.loaded = False
         self.loader = None
         self.chunks = None
+        self.entities = None
+        self.next_entity_id = 1
+        self.observers = list()
 
     def __repr__(self):
         return "Level(%s, size: %i by %i)" % (self.name, self.size.x, self.size.y)
 
     def save(self):
+        if self.entities is not None:
+            self.next_entity_id = self.entities.next_id
+
         self.save_file.upsert(LevelTable, self)
         if self.loader is not None:
-            self.loader.save()
+            return self.loader.save()
+        else:
+            return 0
+
+    def snapshot(self):
+        """
+        Copies the level row and its modified chunks for an asynchronous save
+        """
+        chunks = self.loader.snapshot() if self.loader is not None else []
+        if self.entities is not None:
+            self.next_entity_id = self.entities.next_id
+
+        return copy.copy(self), chunks
+
+    def saved(self, chunks, failed=False):
+        if self.loader is not None:
+            self.loader.saved(chunks, failed)
 
     def init(self):
         if not self.loaded:
             self.loader = ChunkLoader(level_id=self.id,
-                                      save_file=self.save_file)
+                                      save_file=self.save_file,
+                                      prefetcher=self.save_file.prefetcher,
+                                      **self.save_file.chunk_budget)
 
-            self.chunks = ChunkTree(origin=sf.Vector2(0, 0),
-                                    size=self.size,
-                                    loader=self.loader)
+            self.chunks = ChunkIndex(loader=self.loader)
+            self.entities = EntityStore(loader=self.loader,
+                                        next_id=self.next_entity_id,
+                                        level=self)
             self.loaded = True
 
     def get_tile(self, pos):
@@ -105,7 +135,177 @@ class Level(object):
     def set_tile(self, pos, tile):
         self.init()
         self.chunks.set_tile(pos, tile)
+        self.notify(pos)
 
     def set_block(self, pos, block):
         self.init()
-        self.chunks.get_tile(pos).set_block(block)
+        self.chunks.set_block(pos, block)
+        self.notify(pos)
+
+    def spawn(self, type, pos, meta=None):
+        """
+        Creates an entity at a position, returns its handle
+        """
+        self.init()
+        return self.entities.spawn(type, pos.x, pos.y, meta)
+
+    def get_entity(self, entity_id):
+        """
+        Handle of an entity of the loaded chunks, None if it is not loaded
+        """
+        self.init()
+        return self.entities.get(entity_id)
+
+    def entities_in_rect(self, pos, size, type=None):
+        """
+        Entities inside a rectangle of tiles, the chunks covering it are loaded first
+        """
+        self.init()
+        self.prefetch_rect(pos, size)
+        return self.entities.query_rect(pos.x, pos.y, size.x, size.y, type)
+
+    def entities_in_radius(self, pos, radius, type=None):
+        """
+        Entities within a distance of a position, ordered by distance
+        """
+        self.init()
+        self.prefetch_radius(pos, radius)
+        return self.entities.query_radius(pos.x, pos.y, radius, type)
+
+    def nearest_entity(self, pos, radius, type=None):
+        """
+        Closest entity within a distance of a position, None if there is none
+        """
+        self.init()
+        self.prefetch_radius(pos, radius)
+        return self.entities.nearest(pos.x, pos.y, radius, type)
+
+    def prefetch_radius(self, pos, radius):
+        reach = int(math.ceil(radius))
+        x, y = int(math.floor(pos.x)), int(math.floor(pos.y))
+        self.prefetch_rect(sf.Vector2(x - reach, y - reach), sf.Vector2(2 * reach + 1, 2 * reach + 1))
+
+    def add_observer(self, observer):
+        """
+        Observers are told about modified tiles through `invalidate(pos)` and `invalidate_rect(pos, size)`
+        """
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        self.observers.remove(observer)
+
+    def notify(self, pos):
+        for observer in self.observers:
+            observer.invalidate(pos)
+
+    def notify_rect(self, pos, size):
+        for observer in self.observers:
+            observer.invalidate_rect(pos, size)
+
+    def region_slices(self, pos, size, batch_size=64):
+        """
+        Splits a rectangle of tiles by chunk
+        Yields each chunk with the matching slices of the region and of the chunk arrays
+        Chunks are loaded in batches, a chunk must be used before the next one is requested
+        """
+        p1, p2 = Chunk.span(pos, size)
+        cposes = [sf.Vector2(x, y)
+                  for x in range(p1.x, p2.x)
+                  for y in range(p1.y, p2.y)]
+
+        for idx in range(0, len(cposes), batch_size):
+            yield from self.chunk_slices(pos, size, self.loader.get_many(cposes[idx:idx + batch_size]))
+
+    def chunk_slices(self, pos, size, chunks):
+        for chunk in chunks:
+            cx, cy = chunk.pos.x * Chunk.size, chunk.pos.y * Chunk.size
+            x1, x2 = max(pos.x, cx), min(pos.x + size.x, cx + Chunk.size)
+            y1, y2 = max(pos.y, cy), min(pos.y + size.y, cy + Chunk.size)
+
+            region = (slice(x1 - pos.x, x2 - pos.x), slice(y1 - pos.y, y2 - pos.y))
+            local = (slice(x1 - cx, x2 - cx), slice(y1 - cy, y2 - cy))
+            yield chunk, region, local
+
+    def get_region(self, pos, size):
+        """
+        Reads a rectangle of tiles as an array of block ids indexed by [x, y]
+        """
+        self.init()
+        blocks = np.empty((size.x, size.y), dtype=np.uint16)
+        for chunk, region, local in self.region_slices(pos, size):
+            blocks[region] = chunk.tiles.blocks[local]
+
+        return blocks
+
+    def fill_rect(self, pos, size, block, meta=None):
+        """
+        Sets every tile of a rectangle to a block
+        """
+        self.init()
+        block_id = BlockRegistry.instance().get_block_id(block)
+        for chunk, region, local in self.region_slices(pos, size):
+            chunk.tiles.fill(local, block_id, meta)
+
+        self.notify_rect(pos, size)
+
+    def paste(self, pos, blocks):
+        """
+        Copies an array of block ids indexed by [x, y] into the level
+        """
+        self.init()
+        size = sf.Vector2(*blocks.shape)
+        for chunk, region, local in self.region_slices(pos, size):
+            chunk.tiles.paste(local, blocks[region])
+
+        self.notify_rect(pos, size)
+
+    def apply_mask(self, pos, mask, block):
+        """
+        Sets the tiles selected by a boolean array indexed by [x, y] to a block
+        """
+        self.init()
+        block_id = BlockRegistry.instance().get_block_id(block)
+        size = sf.Vector2(*mask.shape)
+        for chunk, region, local in self.region_slices(pos, size):
+            chunk_mask = mask[region]
+            if chunk_mask.any():
+                chunk.tiles.apply_mask(local, chunk_mask, block_id)
+
+        self.notify_rect(pos, size)
+
+    def get_region_meta(self, pos, size):
+        """
+        Reads the metadata of a rectangle of tiles, keyed by position relative to the rectangle
+        """
+        self.init()
+        meta = dict()
+        for chunk, region, local in self.region_slices(pos, size):
+            for (x, y), data in chunk.tiles.meta.items():
+                if local[0].start <= x < local[0].stop and local[1].start <= y < local[1].stop:
+                    meta[(x - local[0].start + region[0].start, y - local[1].start + region[1].start)] = data
+
+        return meta
+
+    def pin_rect(self, pos, size):
+        """
+        Keeps the chunks covering a rectangle of tiles in memory
+        """
+        self.init()
+        p1, p2 = Chunk.span(pos, size)
+        self.loader.pin(sf.Vector2(x, y)
+                        for x in range(p1.x, p2.x)
+                        for y in range(p1.y, p2.y))
+
+    def prefetch_rect(self, pos, size):
+        """
+        Loads the chunks covering a rectangle of tiles in bulk
+        """
+        self.init()
+        self.chunks.prefetch_rect(pos, size)
+
+    def prefetch_around(self, pos):
+        """
+        Reads the chunks around a tile in the background
+        """
+        self.init()
+        self.loader.prefetch_around(sf.Vector2(pos.x >> Chunk.rank, pos.y >> Chunk.rank))
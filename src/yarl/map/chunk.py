@@ -1,31 +1,315 @@
 from sfml import sf
 from yarl.block import BlockRegistry
-from yarl.util import cantor_pairing
-from yarl.tile import Tile
+from yarl.util import pack_key
+from yarl.tile import TileView
 from yarl.schema import ChunkTable
+from collections import OrderedDict
+from queue import Queue, Empty
+import itertools
 import numpy as np
+import struct
+import json
+import zlib
+import ast
+import sys
 
 
 class ChunkLoader(object):
-    def __init__(self, level_id, save_file):
+    """
+    Loads chunks of a level from the save file and keeps them in a bounded LRU pool
+    Modified chunks are written back when they are evicted
+    """
+
+    def __init__(self, level_id, save_file, max_chunks=256, max_bytes=None, prefetcher=None):
         self.level = level_id
         self.save_file = save_file
-        self.pool = dict()
+        self.prefetcher = prefetcher
+        self.arrivals = Queue()
+        # Maps the keys requested from the prefetcher to the session flush count at request time
+        self.pending = dict()
+        self.listeners = list()
+        # Entity store of the level, set by the store itself, its entities follow their chunks in and out of the pool
+        self.entities = None
+        self.pool = OrderedDict()
+        self.pinned = set()
+        # Keys of the chunks an asynchronous save is writing, they stay in the pool until it is done
+        self.saving = set()
+        self.max_chunks = max_chunks
+        self.max_bytes = max_bytes
+        # Estimated size of each pooled chunk, refreshed when it is written
+        self.sizes = dict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return "ChunkLoader{ chunks=%i, bytes=%i, hits=%i, misses=%i, evictions=%i }" % (len(self.pool), self.nbytes,
+                                                                                         self.hits, self.misses,
+                                                                                         self.evictions)
 
     def get(self, cpos):
-        hsh = cantor_pairing(cpos.x, cpos.y)
+        hsh = pack_key(cpos.x, cpos.y)
 
-        if hsh not in self.pool:
-            self.pool[hsh] = self.load_chunk(cpos)
+        chunk = self.pool.get(hsh)
+        if chunk is None and len(self.pending) > 0:
+            self.collect()
+            chunk = self.pool.get(hsh)
 
-        return self.pool[hsh]
+        if chunk is None:
+            self.misses += 1
+            chunk = self.load_chunk(cpos)
+            self.admit(hsh, chunk)
+            self.purge()
+        else:
+            self.hits += 1
+            self.pool.move_to_end(hsh)
+
+        return chunk
+
+    def add_listener(self, listener):
+        """
+        Listeners are told about evicted chunks through `evicted(chunk)`
+        """
+        self.listeners.append(listener)
+
+    def touch(self, chunk):
+        """
+        Marks a chunk obtained from the loader earlier as recently used
+        """
+        self.hits += 1
+        self.pool.move_to_end(chunk.key)
+
+    def admit(self, hsh, chunk):
+        chunk.key = hsh
+        self.pool[hsh] = chunk
+        if self.entities is not None:
+            self.entities.attach(chunk)
+
+        self.measure(chunk)
+
+    def measure(self, chunk):
+        """
+        Updates the estimated size of a pooled chunk, including its metadata and entities
+        """
+        size = chunk.nbytes
+        if self.entities is not None:
+            size += self.entities.bucket_nbytes(chunk.key)
+
+        self.nbytes += size - self.sizes.get(chunk.key, 0)
+        self.sizes[chunk.key] = size
+
+    def get_many(self, cposes):
+        """
+        Gets several chunks, fetching the missing ones with a single query
+        and creating the ones that do not exist yet with a single batched insert
+        The returned chunks stay pooled until the next call to the loader
+        """
+        cposes = list(cposes)
+        chunks = dict()
+        missing = list()
+        if len(self.pending) > 0:
+            self.collect()
+
+        for cpos in cposes:
+            hsh = pack_key(cpos.x, cpos.y)
+            chunk = self.pool.get(hsh)
+            if chunk is None:
+                missing.append(cpos)
+            else:
+                self.hits += 1
+                self.pool.move_to_end(hsh)
+                chunks[hsh] = chunk
+
+        if len(missing) > 0:
+            self.misses += len(missing)
+            for chunk in self.load_chunks(missing):
+                hsh = pack_key(chunk.pos.x, chunk.pos.y)
+                self.admit(hsh, chunk)
+                chunks[hsh] = chunk
+
+        self.purge(protect=chunks)
+
+        return [chunks[pack_key(cpos.x, cpos.y)] for cpos in cposes]
+
+    def prefetch_rect(self, cpos, csize):
+        """
+        Loads all chunks in a rectangle of chunk coordinates
+        """
+        self.get_many(sf.Vector2(x, y)
+                      for x in range(cpos.x, cpos.x + csize.x)
+                      for y in range(cpos.y, cpos.y + csize.y))
+
+    def prefetch_around(self, ccenter):
+        """
+        Asks the background prefetcher for the ring of chunks around a chunk position
+        """
+        if self.prefetcher is None:
+            return
+
+        radius = self.prefetcher.radius
+        cposes = [sf.Vector2(x, y)
+                  for x in range(ccenter.x - radius, ccenter.x + radius + 1)
+                  for y in range(ccenter.y - radius, ccenter.y + radius + 1)]
+        cposes = [cpos for cpos in cposes
+                  if pack_key(cpos.x, cpos.y) not in self.pool
+                  and pack_key(cpos.x, cpos.y) not in self.pending]
+
+        if len(cposes) > 0:
+            flushes = self.save_file.session.flushes
+            self.pending.update((pack_key(cpos.x, cpos.y), flushes) for cpos in cposes)
+            self.prefetcher.request(self.arrivals, self.level, cposes)
+
+    def collect(self):
+        """
+        Moves chunks decoded by the prefetcher into the pool, never blocks
+        Chunks that do not exist yet are created in memory and will be inserted when saved
+        """
+        while True:
+            try:
+                cposes, chunks = self.arrivals.get_nowait()
+            except Empty:
+                break
+
+            found = dict()
+            if chunks is not None:
+                found = {(chunk.pos.x, chunk.pos.y): chunk for chunk in chunks}
+
+            for cpos in cposes:
+                hsh = pack_key(cpos.x, cpos.y)
+                flushes = self.pending.pop(hsh, None)
+                if flushes is None:
+                    # Cancelled, the pooled or saved version is more recent
+                    continue
+
+                if hsh in self.pool or chunks is None:
+                    continue
+
+                if flushes != self.save_file.session.flushes:
+                    # Read before queued writes were flushed, the rows may be stale
+                    continue
+
+                chunk = found.get((cpos.x, cpos.y))
+                if chunk is None:
+                    chunk = Chunk(level_id=self.level,
+                                  pos=cpos)
+                    chunk.dirty = True
+
+                # The prefetcher can not see writes still queued in the session, the live object wins
+                self.admit(hsh, self.save_file.session.merge(ChunkTable, chunk))
+
+        self.purge()
+
+    def pin(self, cposes):
+        """
+        Replaces the set of chunks that can not be evicted
+        """
+        self.pinned = set(pack_key(cpos.x, cpos.y) for cpos in cposes)
+
+    def stats(self):
+        return dict(chunks=len(self.pool),
+                    bytes=self.nbytes,
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions)
 
     def save(self):
-        for hsh, chunk in self.pool.items():
+        """
+        Writes modified chunks in one batch, returns the number of chunks written
+        """
+        if self.entities is not None:
+            self.entities.sync(self.pool)
+
+        dirty = [chunk for chunk in self.pool.values() if chunk.dirty]
+        if len(dirty) == 0:
+            return 0
+
+        for chunk in dirty:
+            self.measure(chunk)
+
+        written = self.save_file.upsert_many(ChunkTable, dirty)
+        for chunk in dirty:
+            chunk.dirty = False
+
+        return written
+
+    def snapshot(self):
+        """
+        Copies the modified chunks for an asynchronous save and marks them clean
+        The originals are kept in the pool until `saved` is called
+        """
+        if self.entities is not None:
+            self.entities.sync(self.pool)
+
+        dirty = [chunk for chunk in self.pool.values() if chunk.dirty]
+        for chunk in dirty:
+            self.measure(chunk)
+            if chunk.id is None:
+                # Rows are created on the game thread so later write-backs never insert them twice
+                self.save_file.upsert(ChunkTable, chunk)
+
+            chunk.dirty = False
+            self.saving.add(chunk.key)
+
+        return [chunk.copy() for chunk in dirty]
+
+    def saved(self, chunks, failed=False):
+        """
+        Releases the chunks of a finished asynchronous save, chunks of a failed one are marked dirty again
+        """
+        for chunk in chunks:
+            self.saving.discard(chunk.key)
+            if failed and chunk.key in self.pool:
+                self.pool[chunk.key].dirty = True
+
+        self.purge()
+
+    def over_budget(self):
+        if self.max_chunks is not None and len(self.pool) > self.max_chunks:
+            return True
+
+        if self.max_bytes is not None and self.nbytes > self.max_bytes:
+            return True
+
+        return False
+
+    def purge(self, protect=()):
+        """
+        Evicts least recently used chunks until the pool fits in its budget
+        The most recently used chunk, the protected keys and the chunks being saved are never evicted
+        Modified chunks are committed before returning, they are no longer held by the pool
+        """
+        if not self.over_budget():
+            return
+
+        victims = [hsh for hsh in itertools.islice(self.pool, len(self.pool) - 1)
+                   if hsh not in self.pinned and hsh not in protect and hsh not in self.saving]
+        written = 0
+        for hsh in victims:
+            if not self.over_budget():
+                break
+
+            written += self.evict(hsh)
+
+        if written > 0:
+            self.save_file.session.flush()
+
+    def evict(self, hsh):
+        chunk = self.pool.pop(hsh)
+        self.pending.pop(hsh, None)
+        if self.entities is not None:
+            self.entities.detach(chunk)
+        written = chunk.dirty
+        if written:
             self.save_file.upsert(ChunkTable, chunk)
+            chunk.dirty = False
 
-    def purge(self):
-        pass
+        self.nbytes -= self.sizes.pop(hsh)
+        self.evictions += 1
+        for listener in self.listeners:
+            listener.evicted(chunk)
+
+        return written
 
     def load_chunk(self, cpos):
         chunk = self.save_file.select(ChunkTable,
@@ -39,127 +323,336 @@ class ChunkLoader(object):
 
         return chunk
 
+    def load_chunks(self, cposes):
+        chunks = self.save_file.select_many(ChunkTable,
+                                            positions=cposes,
+                                            level_id=self.level)
 
-class ChunkTree(object):
-    def __init__(self, origin, size, loader, is_leaf=False):
-        self.origin = origin
-        self.size = size
-        self.loader = loader
-        self.is_leaf = is_leaf
-        if is_leaf:
-            self.chunks = np.ndarray(shape=(size.x, size.y), dtype=Chunk)
-        else:
-            self.chunks = np.ndarray(shape=(2, 2), dtype=ChunkTree)
+        found = set((chunk.pos.x, chunk.pos.y) for chunk in chunks)
+        created = [Chunk(level_id=self.level, pos=cpos)
+                   for cpos in cposes
+                   if (cpos.x, cpos.y) not in found]
 
-    def __repr__(self):
-        return "ChunkTree{ origin=(%i, %i), size=(%i, %i), is_leaf=%i }" % (self.origin.x, self.origin.y,
-                                                                            self.size.x, self.size.y,
-                                                                            self.is_leaf)
+        if len(created) > 0:
+            self.save_file.insert_many(ChunkTable, created)
 
-    def get_tile(self, pos):
-        cpos = sf.Vector2(pos.x >> Chunk.rank,
-                          pos.y >> Chunk.rank)
+        return chunks + created
 
-        if self.is_leaf:
-            container = self.get_chunk(cpos)
-        else:
-            container = self.get_cell(cpos)
 
-        return container.get_tile(pos)
+class ChunkIndex(object):
+    """
+    Flat spatial index of the chunks of a level, keyed by packed integer chunk coordinates
+    Chunks are owned by the loader, the index forgets them when they are evicted
+    """
 
-    def set_tile(self, pos, tile):
-        cpos = sf.Vector2(pos.x >> Chunk.rank,
-                          pos.y >> Chunk.rank)
+    def __init__(self, loader):
+        self.loader = loader
+        self.chunks = dict()
+        loader.add_listener(self)
 
-        if self.is_leaf:
-            container = self.get_chunk(cpos)
+    def __repr__(self):
+        return "ChunkIndex{ chunks=%i }" % len(self.chunks)
+
+    def evicted(self, chunk):
+        self.chunks.pop(pack_key(chunk.pos.x, chunk.pos.y), None)
+
+    def locate(self, x, y):
+        """
+        Finds the chunk holding the tile at (x, y) and the offset of the tile inside it
+        """
+        cx, cy = x >> Chunk.rank, y >> Chunk.rank
+        key = pack_key(cx, cy)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.loader.get(sf.Vector2(cx, cy))
+            self.chunks[key] = chunk
         else:
-            container = self.get_cell(cpos)
+            self.loader.touch(chunk)
 
-        container.set_tile(pos, tile)
+        return chunk, x & Chunk.mask, y & Chunk.mask
 
     def get_chunk(self, cpos):
-        if self.is_leaf:
-            key = (cpos.x - self.origin.x, cpos.y - self.origin.y)
-            if key not in self.chunks:
-                self.chunks[key] = self.loader.get(cpos)
+        chunk, lx, ly = self.locate(cpos.x << Chunk.rank, cpos.y << Chunk.rank)
+        return chunk
+
+    def get_tile(self, pos):
+        chunk, lx, ly = self.locate(pos.x, pos.y)
+        return chunk.tiles.get_tile(lx, ly)
 
-            return self.chunks[key]
+    def set_tile(self, pos, tile):
+        chunk, lx, ly = self.locate(pos.x, pos.y)
+        chunk.tiles.set_tile(lx, ly, tile)
+
+    def set_block(self, pos, block, meta=None):
+        chunk, lx, ly = self.locate(pos.x, pos.y)
+        chunk.tiles.set_block(lx, ly, block, meta)
+
+    def prefetch_rect(self, pos, size):
+        """
+        Loads all chunks covering a rectangle of tiles
+        """
+        p1, p2 = Chunk.span(pos, size)
+        self.loader.prefetch_rect(p1, p2 - p1)
+
+
+class TileMatrix(object):
+    """
+    Block storage of a chunk
+    Block ids are kept in a dense integer array and metadata in a sparse side table,
+    tiles are views over a cell created on demand
+    """
+
+    # Binary format: magic, version, width, height, length of the metadata table
+    magic = b'YTM'
+    version = 2
+    header = struct.Struct('<3sBHHI')
+    block_dtype = np.dtype('<u2')
+
+    # Version 2 adds an encoding byte after the header, the body can be deflated
+    UNIFORM = 0
+    PALETTE = 1
+    RAW = 2
+    DEFLATED = 0x80
+
+    # Version written by `pack`, 1 is kept to compare both codecs
+    write_version = 2
+    # zlib level of version 2 bodies, None disables compression
+    compression = 6
+
+    def __init__(self, shape, blocks=None, meta=None):
+        self.shape = tuple(shape)
+        if blocks is None:
+            registry = BlockRegistry.instance()
+            void_id = registry.get_block_id(registry.get('block.void'))
+            self.blocks = np.full(self.shape, void_id, dtype=np.uint16)
+        else:
+            self.blocks = blocks
+
+        self.meta = dict() if meta is None else meta
+        self.dirty = False
+
+    @property
+    def nbytes(self):
+        """
+        Estimated memory use, the block array and a shallow measure of the metadata dicts
+        """
+        if len(self.meta) == 0:
+            return self.blocks.nbytes
+
+        return self.blocks.nbytes + sys.getsizeof(self.meta) + sum(map(sys.getsizeof, self.meta.values()))
+
+    def get_tile(self, x, y):
+        return TileView(self, x, y)
+
+    def set_tile(self, x, y, tile):
+        self.set_block(x, y, tile.block, tile.meta)
+
+    def get_block(self, x, y):
+        return BlockRegistry.instance().from_id(self.blocks[x, y])
+
+    def set_block(self, x, y, block, meta=None):
+        self.blocks[x, y] = BlockRegistry.instance().get_block_id(block)
+        self.set_meta(x, y, meta)
+
+    def fill(self, area, block_id, meta=None):
+        """
+        Sets every tile of an area given as a pair of slices
+        """
+        self.blocks[area] = block_id
+        self.clear_meta(area)
+        if meta:
+            xs, ys = area
+            for x in range(xs.start, xs.stop):
+                for y in range(ys.start, ys.stop):
+                    self.meta[(x, y)] = dict(meta)
+
+        self.dirty = True
+
+    def paste(self, area, block_ids):
+        self.blocks[area] = block_ids
+        self.clear_meta(area)
+        self.dirty = True
+
+    def apply_mask(self, area, mask, block_id):
+        self.blocks[area][mask] = block_id
+        xs, ys = area
+        for x, y in list(self.meta):
+            if xs.start <= x < xs.stop and ys.start <= y < ys.stop and mask[x - xs.start, y - ys.start]:
+                del self.meta[(x, y)]
+
+        self.dirty = True
+
+    def clear_meta(self, area):
+        xs, ys = area
+        for x, y in list(self.meta):
+            if xs.start <= x < xs.stop and ys.start <= y < ys.stop:
+                del self.meta[(x, y)]
+
+    def get_meta(self, x, y):
+        return self.meta.get((x, y), {})
+
+    def copy(self):
+        """
+        Detached copy of the blocks and metadata, the dirty flag is not copied
+        """
+        return TileMatrix(self.shape, self.blocks.copy(), {cell: dict(data) for cell, data in self.meta.items()})
+
+    def set_meta(self, x, y, meta):
+        if meta:
+            self.meta[(x, y)] = dict(meta)
         else:
-            return self.get_cell(cpos).get_chunk(cpos)
+            self.meta.pop((x, y), None)
+        self.dirty = True
 
-    def get_cell(self, cpos):
-        dist = cpos - self.origin
-        key = (0 if dist.x < 0 else 1, 0 if dist.y < 0 else 1)
-        if self.chunks[key] is None:
-            self.chunks[key] = self.build_cell(dist)
+    def pack(self):
+        meta = [[int(x), int(y), data] for (x, y), data in self.meta.items()]
+        meta = json.dumps(meta).encode('utf-8') if len(meta) > 0 else b''
 
-        return self.chunks[key]
+        width, height = self.shape
+        header = TileMatrix.header.pack(TileMatrix.magic, TileMatrix.write_version,
+                                        width, height, len(meta))
 
-    def build_cell(self, dist):
-        cell_size = self.size / 2
+        if TileMatrix.write_version == 1:
+            return header + self.blocks.astype(TileMatrix.block_dtype).tobytes() + meta
 
-        is_leaf = cell_size.x <= 2 or cell_size.y <= 2
+        encoding, body = TileMatrix.encode_blocks(self.blocks)
+        body += meta
+        if TileMatrix.compression is not None and len(body) > 64:
+            deflated = zlib.compress(body, TileMatrix.compression)
+            if len(deflated) < len(body):
+                encoding, body = encoding | TileMatrix.DEFLATED, deflated
 
-        if is_leaf:
-            cell_origin = sf.Vector2(self.origin.x + (-1 if dist.x < 0 else 0) * cell_size.x,
-                                     self.origin.y + (-1 if dist.y < 0 else 0) * cell_size.y)
-        else:
-            cell_origin = sf.Vector2(self.origin.x + (-1 if dist.x < 0 else 1) * cell_size.x // 2,
-                                     self.origin.y + (-1 if dist.y < 0 else 1) * cell_size.y // 2)
+        return header + bytes((encoding,)) + body
 
-        cell = ChunkTree(origin=cell_origin,
-                         size=cell_size,
-                         loader=self.loader,
-                         is_leaf=is_leaf)
-        return cell
+    @staticmethod
+    def encode_blocks(blocks):
+        """
+        Encodes block ids as a single id for uniform chunks, palette indices packed on 1, 2, 4 or 8 bits
+        when that is smaller than the raw ids, and raw ids otherwise
+        """
+        flat = blocks.ravel()
+        if (flat == flat[0]).all():
+            return TileMatrix.UNIFORM, flat[:1].astype(TileMatrix.block_dtype).tobytes()
 
+        palette, indices = np.unique(flat, return_inverse=True)
 
-class TileMatrix(np.ndarray):
-    def __new__(cls, shape):
-        return super(TileMatrix, cls).__new__(cls, shape=shape, dtype=Tile)
+        itemsize = TileMatrix.block_dtype.itemsize
+        bits = TileMatrix.index_bits(len(palette)) if len(palette) <= 256 else None
+        if bits is None or 2 + len(palette) * itemsize + (blocks.size * bits + 7) // 8 >= blocks.size * itemsize:
+            return TileMatrix.RAW, blocks.astype(TileMatrix.block_dtype).tobytes()
 
-    def pack(self):
-        registry = BlockRegistry.instance()
-        shape = "%s:%s" % self.shape
+        planes = (indices[:, None] >> np.arange(bits)) & 1
+        packed = np.packbits(planes.astype(np.uint8).ravel(), bitorder='little')
 
-        def pack_tile(tile):
-            if tile is None:
-                return "0:0"
-            else:
-                return "%s:%s" % (registry.get_block_id(tile.block), tile.meta)
+        return TileMatrix.PALETTE, (struct.pack('<H', len(palette)) +
+                                    palette.astype(TileMatrix.block_dtype).tobytes() +
+                                    packed.tobytes())
 
-        def pack_row(row):
-            prow = map(pack_tile, row)
-            return str.join(';', prow)
+    @staticmethod
+    def decode_blocks(encoding, body, shape):
+        """
+        Inverse of `encode_blocks`, returns the block array and the number of bytes read
+        """
+        count = shape[0] * shape[1]
+        if encoding == TileMatrix.UNIFORM:
+            block_id = np.frombuffer(body, dtype=TileMatrix.block_dtype, count=1)[0]
+            return np.full(shape, block_id, dtype=np.uint16), TileMatrix.block_dtype.itemsize
+
+        if encoding == TileMatrix.RAW:
+            blocks = np.frombuffer(body, dtype=TileMatrix.block_dtype, count=count)
+            return blocks.reshape(shape).astype(np.uint16), blocks.nbytes
+
+        if encoding != TileMatrix.PALETTE:
+            raise ValueError("Unknown tile matrix encoding %i" % encoding)
+
+        palette_len, = struct.unpack_from('<H', body)
+        palette = np.frombuffer(body, dtype=TileMatrix.block_dtype, count=palette_len, offset=2)
+        offset = 2 + palette.nbytes
+
+        bits = TileMatrix.index_bits(palette_len)
+        packed_len = (count * bits + 7) // 8
+        planes = np.unpackbits(np.frombuffer(body, dtype=np.uint8, count=packed_len, offset=offset),
+                               count=count * bits, bitorder='little')
+        indices = planes.reshape((count, bits)).astype(np.uint16) << np.arange(bits, dtype=np.uint16)
+        blocks = palette[indices.sum(axis=1)].reshape(shape).astype(np.uint16)
+
+        return blocks, offset + packed_len
 
-        items = str.join('\n', map(pack_row, self))
+    @staticmethod
+    def index_bits(palette_len):
+        for bits in (1, 2, 4, 8):
+            if palette_len <= 1 << bits:
+                return bits
 
-        return (shape + '\n' + items).encode("ascii")
+        raise ValueError("Palette of %i blocks can not be bit-packed" % palette_len)
 
     @staticmethod
     def unpack(packed):
+        if not packed.startswith(TileMatrix.magic):
+            return TileMatrix.unpack_text(packed)
+
+        magic, version, width, height, meta_len = TileMatrix.header.unpack_from(packed)
+        if version > TileMatrix.version:
+            raise ValueError("Unsupported tile matrix version %i" % version)
+
+        offset = TileMatrix.header.size
+        if version == 1:
+            body = packed[offset:]
+            blocks = np.frombuffer(body,
+                                   dtype=TileMatrix.block_dtype,
+                                   count=width * height)
+            blocks = blocks.reshape((width, height)).astype(np.uint16)
+            offset = blocks.nbytes
+        else:
+            encoding = packed[offset]
+            body = packed[offset + 1:]
+            if encoding & TileMatrix.DEFLATED:
+                body = zlib.decompress(body)
+
+            blocks, offset = TileMatrix.decode_blocks(encoding & ~TileMatrix.DEFLATED, body, (width, height))
+
+        meta = dict()
+        if meta_len > 0:
+            for x, y, data in json.loads(bytes(body[offset:offset + meta_len]).decode('utf-8')):
+                meta[(x, y)] = data
+
+        return TileMatrix(shape=(width, height),
+                          blocks=blocks,
+                          meta=meta)
+
+    @staticmethod
+    def unpack_text(packed):
+        """
+        Reads the legacy "id:meta;id:meta" text format
+        """
         shape_str, *rows = packed.decode('ascii').split('\n')
-        shape = list(map(int, shape_str.split(":")))
-        matrix = TileMatrix(shape=shape)
-        registry = BlockRegistry.instance()
+        shape = tuple(map(int, shape_str.split(":")))
+        blocks = np.zeros(shape, dtype=np.uint16)
+        meta = dict()
         for row_idx, row_str in enumerate(rows):
             cols = row_str.split(';')
             for col_idx, col_str in enumerate(cols):
-                block_id, meta = col_str.split(':')
-                block = registry.from_id(block_id)
-                matrix[row_idx, col_idx] = Tile(block=block,
-                                                meta=meta)
+                block_id, meta_str = col_str.split(':', 1)
+                blocks[row_idx, col_idx] = int(block_id)
+                if meta_str not in ('0', '{}', 'None'):
+                    try:
+                        meta[(row_idx, col_idx)] = ast.literal_eval(meta_str)
+                    except (ValueError, SyntaxError):
+                        meta[(row_idx, col_idx)] = meta_str
 
-        return matrix
+        return TileMatrix(shape=shape,
+                          blocks=blocks,
+                          meta=meta)
 
 
 class Chunk(object):
     rank = 4
     size = 2 ** rank
+    mask = size - 1
 
-    def __init__(self, level_id, pos, tiles=None):
+    def __init__(self, level_id, pos, tiles=None, entities=None):
         self.id = None
+        self.key = None
         self.level_id = level_id
         self.pos = pos
         if tiles is None:
@@ -167,17 +660,48 @@ class Chunk(object):
         else:
             self.tiles = tiles
 
+        # Saved entities of the chunk, live ones are in the entity store of the level
+        self.entities = entities
+
     def __repr__(self):
         return "Chunk{ pos=(%i, %i) }" % (self.pos.x, self.pos.y)
 
-    def get_tile(self, pos):
-        rpos = pos - (self.pos * Chunk.size)
+    def copy(self):
+        # Entity lists are replaced, never modified, the copy can share them
+        chunk = Chunk(self.level_id, sf.Vector2(self.pos.x, self.pos.y), self.tiles.copy(), self.entities)
+        chunk.id = self.id
+        chunk.key = self.key
+        return chunk
 
-        if self.tiles[rpos.x, rpos.y] is None:
-            self.tiles[rpos.x, rpos.y] = Tile()
+    @staticmethod
+    def span(pos, size):
+        """
+        Computes the chunk coordinates covering a rectangle of tiles, upper bound is exclusive
+        """
+        p1 = sf.Vector2(pos.x >> Chunk.rank, pos.y >> Chunk.rank)
+        p2 = sf.Vector2(((pos.x + size.x - 1) >> Chunk.rank) + 1,
+                        ((pos.y + size.y - 1) >> Chunk.rank) + 1)
+        return p1, p2
+
+    @property
+    def nbytes(self):
+        if self.entities is None:
+            return self.tiles.nbytes
+
+        return self.tiles.nbytes + self.entities.nbytes
+
+    @property
+    def dirty(self):
+        return self.tiles.dirty
+
+    @dirty.setter
+    def dirty(self, value):
+        self.tiles.dirty = value
 
-        return self.tiles[rpos.x, rpos.y]
+    def get_tile(self, pos):
+        rpos = pos - (self.pos * Chunk.size)
+        return self.tiles.get_tile(rpos.x, rpos.y)
 
     def set_tile(self, pos, tile):
         rpos = pos - (self.pos * Chunk.size)
-        self.tiles[rpos.x, rpos.y] = tile
+        self.tiles.set_tile(rpos.x, rpos.y, tile)
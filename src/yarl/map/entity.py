@@ -0,0 +1,566 @@
+from collections.abc import MutableMapping
+from sfml import sf
+from yarl.map.chunk import Chunk
+from yarl.schema import LevelTable
+from yarl.util import pack_key, unpack_key
+import numpy as np
+import logging
+import struct
+import json
+import math
+import sys
+
+logger = logging.getLogger(__name__)
+
+
+class Entity(object):
+    """
+    Handle to an entity of an `EntityStore`
+    Fields live in the columns of the store, the handle goes stale once its entity is removed or unloaded
+    """
+
+    __slots__ = ('store', 'slot', 'generation')
+
+    def __init__(self, store, slot):
+        self.store = store
+        self.slot = slot
+        self.generation = int(store.generations[slot])
+
+    def __repr__(self):
+        if not self.alive:
+            return "Entity{ stale }"
+
+        return "Entity{ id=%i, type=%s, pos=(%.2f, %.2f) }" % (self.id, self.type, self.x, self.y)
+
+    def __eq__(self, other):
+        return (isinstance(other, Entity) and self.store is other.store and
+                self.slot == other.slot and self.generation == other.generation)
+
+    def __hash__(self):
+        return hash((self.slot, self.generation))
+
+    @property
+    def alive(self):
+        return self.store.generations[self.slot] == self.generation
+
+    def check(self):
+        if not self.alive:
+            raise RuntimeError("Stale entity handle")
+
+        return self.slot
+
+    @property
+    def id(self):
+        return int(self.store.ids[self.check()])
+
+    @property
+    def type(self):
+        return self.store.type_names[self.store.types[self.check()]]
+
+    @property
+    def x(self):
+        return float(self.store.xs[self.check()])
+
+    @property
+    def y(self):
+        return float(self.store.ys[self.check()])
+
+    @property
+    def meta(self):
+        return EntityMeta(self)
+
+    def set_meta(self, meta):
+        self.store.set_meta(self.check(), meta)
+
+    def move(self, x, y):
+        self.store.move(self.check(), x, y)
+
+    def remove(self):
+        self.store.remove(self.check())
+
+
+class EntityMeta(MutableMapping):
+    """
+    Live mapping over the metadata of an entity
+    Writes go through the store, so they are kept even if the entity had no metadata and mark its chunk dirty
+    """
+    __slots__ = ('entity',)
+
+    def __init__(self, entity):
+        self.entity = entity
+
+    def __repr__(self):
+        return "EntityMeta(%r)" % self.data()
+
+    def data(self):
+        return self.entity.store.meta.get(self.entity.check(), {})
+
+    def __getitem__(self, key):
+        return self.data()[key]
+
+    def __setitem__(self, key, value):
+        meta = dict(self.data())
+        meta[key] = value
+        self.entity.set_meta(meta)
+
+    def __delitem__(self, key):
+        meta = dict(self.data())
+        del meta[key]
+        self.entity.set_meta(meta)
+
+    def __iter__(self):
+        return iter(self.data())
+
+    def __len__(self):
+        return len(self.data())
+
+
+class EntityList(object):
+    """
+    Entities of a chunk as stored in the save file
+    Fields are kept in a structured array, type names and metadata in side tables
+    Lists are replaced when their chunk is written back, never modified
+    """
+
+    # Binary format: magic, version, number of entities, length of the type table, length of the metadata table
+    magic = b'YEL'
+    version = 1
+    header = struct.Struct('<3sBIHI')
+    record_dtype = np.dtype([('id', '<i8'), ('type', '<u2'), ('x', '<f4'), ('y', '<f4')])
+
+    def __init__(self, records=None, types=None, meta=None):
+        self.records = np.zeros(0, dtype=EntityList.record_dtype) if records is None else records
+        self.types = list() if types is None else types
+        self.meta = dict() if meta is None else meta
+
+    def __repr__(self):
+        return "EntityList{ entities=%i }" % len(self)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def nbytes(self):
+        return (self.records.nbytes + sum(map(len, self.types)) +
+                sum(map(sys.getsizeof, self.meta.values())))
+
+    def pack(self):
+        types = "\n".join(self.types).encode('utf-8')
+        meta = [[int(entity_id), data] for entity_id, data in self.meta.items()]
+        meta = json.dumps(meta).encode('utf-8') if len(meta) > 0 else b''
+
+        header = EntityList.header.pack(EntityList.magic, EntityList.version, len(self.records), len(types), len(meta))
+        return header + self.records.astype(EntityList.record_dtype).tobytes() + types + meta
+
+    @staticmethod
+    def unpack(packed):
+        magic, version, count, types_len, meta_len = EntityList.header.unpack_from(packed)
+        if magic != EntityList.magic:
+            raise ValueError("Not an entity list")
+        if version > EntityList.version:
+            raise ValueError("Unsupported entity list version %i" % version)
+
+        offset = EntityList.header.size
+        records = np.frombuffer(packed, dtype=EntityList.record_dtype, count=count, offset=offset).copy()
+        offset += records.nbytes
+
+        types = bytes(packed[offset:offset + types_len]).decode('utf-8')
+        types = types.split("\n") if types_len > 0 else []
+        offset += types_len
+
+        meta = dict()
+        if meta_len > 0:
+            for entity_id, data in json.loads(bytes(packed[offset:offset + meta_len]).decode('utf-8')):
+                meta[entity_id] = data
+
+        return EntityList(records, types, meta)
+
+
+class EntityStore(object):
+    """
+    Columnar storage of the entities of the loaded chunks of a level
+    Each field is a typed array indexed by slot, slots of removed entities are reused
+    Entities are bucketed by chunk, the buckets serve spatial queries and the per-chunk save format
+    """
+
+    columns = (
+        ('ids', np.int64),
+        ('types', np.uint16),
+        ('xs', np.float32),
+        ('ys', np.float32),
+        ('generations', np.uint32),
+        ('alive', np.bool_),
+    )
+
+    def __init__(self, loader=None, next_id=1, capacity=256, level=None):
+        self.loader = loader
+        # Level row holding the next id, written before any chunk can store an id past it
+        self.level = level
+        self.next_id = next_id
+        for name, dtype in self.columns:
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+
+        self.free = list(range(capacity - 1, -1, -1))
+        # Maps entity ids to slots
+        self.slots = dict()
+        # Sparse metadata, keyed by slot
+        self.meta = dict()
+        self.type_names = list()
+        self.type_ids = dict()
+        # Maps packed chunk coordinates to the set of slots inside the chunk
+        self.buckets = dict()
+        # Chunk coordinates bounding every bucket created so far, limits the search of `nearest`
+        self.bounds = None
+        # Chunks whose entities are in the store, and the ones with entities modified since the last write back
+        self.attached = set()
+        self.dirty = set()
+
+        if loader is not None:
+            loader.entities = self
+            for chunk in loader.pool.values():
+                self.attach(chunk)
+
+    def __repr__(self):
+        return "EntityStore{ entities=%i, chunks=%i }" % (len(self), len(self.attached))
+
+    def __len__(self):
+        return len(self.slots)
+
+    @property
+    def capacity(self):
+        return len(self.ids)
+
+    @property
+    def entity_nbytes(self):
+        return sum(column.itemsize for column in (getattr(self, name) for name, dtype in self.columns))
+
+    def bucket_nbytes(self, key):
+        """
+        Estimated size of the live entities of a chunk, their columns and metadata
+        """
+        bucket = self.buckets.get(key)
+        if not bucket:
+            return 0
+
+        return len(bucket) * self.entity_nbytes + sum(sys.getsizeof(self.meta[slot])
+                                                      for slot in bucket if slot in self.meta)
+
+    @staticmethod
+    def chunk_key(x, y):
+        return pack_key(int(math.floor(x)) >> Chunk.rank, int(math.floor(y)) >> Chunk.rank)
+
+    def type_id(self, name):
+        type_id = self.type_ids.get(name)
+        if type_id is None:
+            type_id = len(self.type_names)
+            self.type_names.append(name)
+            self.type_ids[name] = type_id
+
+        return type_id
+
+    def allocate(self, count):
+        """
+        Takes `count` free slots, columns double in size when they run out
+        """
+        while len(self.free) < count:
+            capacity = self.capacity
+            for name, dtype in self.columns:
+                column = np.zeros(capacity * 2, dtype=dtype)
+                column[:capacity] = getattr(self, name)
+                setattr(self, name, column)
+
+            self.free.extend(range(capacity * 2 - 1, capacity - 1, -1))
+
+        slots = self.free[len(self.free) - count:]
+        del self.free[len(self.free) - count:]
+        return np.array(slots, dtype=np.int64)
+
+    def bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = set()
+            cx, cy = unpack_key(key)
+            if self.bounds is None:
+                self.bounds = (cx, cy, cx, cy)
+            else:
+                x1, y1, x2, y2 = self.bounds
+                self.bounds = (min(x1, cx), min(y1, cy), max(x2, cx), max(y2, cy))
+
+        return bucket
+
+    def require(self, key):
+        """
+        Loads the chunk of a bucket through the loader, so its saved entities join the store
+        """
+        if key in self.attached:
+            return
+
+        if self.loader is None:
+            self.attached.add(key)
+        else:
+            self.loader.get(sf.Vector2(*unpack_key(key)))
+
+    def spawn(self, type, x, y, meta=None, entity_id=None):
+        """
+        Creates an entity and returns its handle, ids are allocated by the store unless given
+        """
+        if entity_id is None:
+            entity_id = self.next_id
+        self.next_id = max(self.next_id, entity_id + 1)
+
+        slot = int(self.allocate(1)[0])
+        self.ids[slot] = entity_id
+        self.types[slot] = self.type_id(type)
+        self.xs[slot] = x
+        self.ys[slot] = y
+        self.alive[slot] = True
+        self.slots[entity_id] = slot
+        if meta:
+            self.meta[slot] = dict(meta)
+
+        # Keys are computed from the stored positions, rounding to float32 may cross a chunk border
+        key = EntityStore.chunk_key(self.xs[slot], self.ys[slot])
+        self.bucket(key).add(slot)
+        self.dirty.add(key)
+        self.require(key)
+
+        return Entity(self, slot)
+
+    def get(self, entity_id):
+        slot = self.slots.get(entity_id)
+        return None if slot is None else Entity(self, slot)
+
+    def move(self, slot, x, y):
+        old_key = EntityStore.chunk_key(self.xs[slot], self.ys[slot])
+        self.xs[slot] = x
+        self.ys[slot] = y
+        new_key = EntityStore.chunk_key(self.xs[slot], self.ys[slot])
+        self.dirty.add(old_key)
+
+        if new_key != old_key:
+            # The entity leaves its bucket before the new chunk is loaded, loading may evict the old one
+            self.buckets[old_key].discard(slot)
+            self.bucket(new_key).add(slot)
+            self.dirty.add(new_key)
+            self.require(new_key)
+
+    def set_meta(self, slot, meta):
+        if meta:
+            self.meta[slot] = dict(meta)
+        else:
+            self.meta.pop(slot, None)
+
+        self.dirty.add(EntityStore.chunk_key(self.xs[slot], self.ys[slot]))
+
+    def remove(self, slot):
+        key = EntityStore.chunk_key(self.xs[slot], self.ys[slot])
+        self.buckets[key].discard(slot)
+        self.dirty.add(key)
+        self.release(slot)
+
+    def release(self, slot):
+        del self.slots[int(self.ids[slot])]
+        self.meta.pop(slot, None)
+        self.alive[slot] = False
+        self.generations[slot] += 1
+        self.free.append(slot)
+
+    def attach(self, chunk):
+        """
+        Adds the saved entities of a chunk admitted by the loader
+        """
+        if chunk.key in self.attached:
+            return
+
+        self.attached.add(chunk.key)
+        entities = chunk.entities
+        if entities is None or len(entities) == 0:
+            return
+
+        records = entities.records
+        ids = records['id'].tolist()
+        self.next_id = max(self.next_id, max(ids) + 1)
+
+        live_ids = ids
+        duplicates = [idx for idx, entity_id in enumerate(ids) if entity_id in self.slots]
+        if len(duplicates) > 0:
+            # The live entity keeps its id, the stored one gets a new id and its chunk is written again
+            logger.warning("Renumbering %i entities of chunk (%i, %i), their ids are already used",
+                           len(duplicates), *unpack_key(chunk.key))
+            live_ids = list(ids)
+            for idx in duplicates:
+                live_ids[idx] = self.next_id
+                self.next_id += 1
+
+            self.dirty.add(chunk.key)
+
+        type_map = np.array([self.type_id(name) for name in entities.types], dtype=np.uint16)
+        slots = self.allocate(len(records))
+        self.ids[slots] = live_ids
+        self.types[slots] = type_map[records['type']]
+        self.xs[slots] = records['x']
+        self.ys[slots] = records['y']
+        self.alive[slots] = True
+
+        slot_list = slots.tolist()
+        self.slots.update(zip(live_ids, slot_list))
+        self.bucket(chunk.key).update(slot_list)
+
+        # Metadata is keyed by the stored ids
+        for slot, entity_id in zip(slot_list, ids):
+            data = entities.meta.get(entity_id)
+            if data:
+                self.meta[slot] = data
+
+    def write_back(self, chunk):
+        """
+        Replaces the entity list of a chunk with the entities of its bucket if they were modified
+        """
+        if chunk.key not in self.dirty:
+            return
+
+        self.dirty.discard(chunk.key)
+        chunk.entities = self.pack(chunk.key)
+        chunk.dirty = True
+        self.store_next_id()
+
+    def store_next_id(self):
+        """
+        Queues the level row when ids were allocated since it was last written
+        It is committed with the chunk, so a reopened level never hands out a stored id again
+        """
+        if self.level is not None and self.level.next_entity_id < self.next_id:
+            self.level.next_entity_id = self.next_id
+            self.level.save_file.upsert(LevelTable, self.level)
+
+    def sync(self, pool):
+        """
+        Writes back the modified entities of the chunks of a pool, keyed by packed chunk coordinates
+        """
+        for key in list(self.dirty):
+            chunk = pool.get(key)
+            if chunk is not None:
+                self.write_back(chunk)
+
+    def detach(self, chunk):
+        """
+        Writes back the entities of a chunk evicted by the loader and drops them from the store
+        """
+        self.write_back(chunk)
+        self.attached.discard(chunk.key)
+        for slot in self.buckets.pop(chunk.key, ()):
+            self.release(slot)
+
+    def pack(self, key):
+        """
+        Builds the entity list of a bucket, None when it is empty
+        """
+        bucket = self.buckets.get(key)
+        if not bucket:
+            return None
+
+        slots = np.array(sorted(bucket), dtype=np.int64)
+        type_ids, type_idx = np.unique(self.types[slots], return_inverse=True)
+
+        records = np.empty(len(slots), dtype=EntityList.record_dtype)
+        records['id'] = self.ids[slots]
+        records['type'] = type_idx
+        records['x'] = self.xs[slots]
+        records['y'] = self.ys[slots]
+
+        meta = {int(self.ids[slot]): self.meta[slot] for slot in slots.tolist() if slot in self.meta}
+        return EntityList(records, [self.type_names[type_id] for type_id in type_ids], meta)
+
+    def candidates(self, x1, y1, x2, y2, type=None):
+        """
+        Slots of the buckets overlapping a rectangle of positions, upper bound is inclusive
+        """
+        cx1, cy1 = int(math.floor(x1)) >> Chunk.rank, int(math.floor(y1)) >> Chunk.rank
+        cx2, cy2 = int(math.floor(x2)) >> Chunk.rank, int(math.floor(y2)) >> Chunk.rank
+
+        if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > len(self.buckets):
+            # Fewer buckets than chunks in the rectangle, scan the buckets instead
+            buckets = list()
+            for key, bucket in self.buckets.items():
+                bx, by = unpack_key(key)
+                if cx1 <= bx <= cx2 and cy1 <= by <= cy2:
+                    buckets.append(bucket)
+        else:
+            buckets = [self.buckets.get(pack_key(cx, cy))
+                       for cx in range(cx1, cx2 + 1)
+                       for cy in range(cy1, cy2 + 1)]
+
+        slots = [slot for bucket in buckets if bucket for slot in bucket]
+        slots = np.array(slots, dtype=np.int64)
+        if type is not None:
+            type_id = self.type_ids.get(type)
+            if type_id is None:
+                return slots[:0]
+
+            slots = slots[self.types[slots] == type_id]
+
+        return slots
+
+    def handles(self, slots):
+        return [Entity(self, slot) for slot in slots.tolist()]
+
+    def query_rect(self, x, y, width, height, type=None):
+        """
+        Entities inside a rectangle, the upper bound is exclusive
+        """
+        slots = self.candidates(x, y, x + width, y + height, type)
+        xs, ys = self.xs[slots], self.ys[slots]
+        mask = (xs >= x) & (xs < x + width) & (ys >= y) & (ys < y + height)
+        return self.handles(slots[mask])
+
+    def query_radius(self, x, y, radius, type=None):
+        """
+        Entities within a distance of a position, ordered by distance
+        """
+        slots = self.candidates(x - radius, y - radius, x + radius, y + radius, type)
+        dist = (self.xs[slots] - x) ** 2 + (self.ys[slots] - y) ** 2
+        mask = dist <= radius * radius
+        slots, dist = slots[mask], dist[mask]
+        return self.handles(slots[np.argsort(dist, kind='mergesort')])
+
+    def nearest(self, x, y, max_radius=None, type=None):
+        """
+        Closest entity to a position, searched ring by ring of chunks around it
+        Returns None when there is none within `max_radius`
+        """
+        if len(self.slots) == 0:
+            return None
+
+        cx, cy = int(math.floor(x)) >> Chunk.rank, int(math.floor(y)) >> Chunk.rank
+        x1, y1, x2, y2 = self.bounds
+        rings = max(cx - x1, cy - y1, x2 - cx, y2 - cy)
+        if max_radius is not None:
+            rings = min(rings, int(math.ceil(max_radius)) // Chunk.size + 1)
+
+        best_slot, best_dist = None, None
+        for ring in range(rings + 1):
+            if ring == 0:
+                slots = self.candidates(x, y, x, y, type)
+            else:
+                # Chunks of the ring, top and bottom rows then the left and right columns
+                x1, x2 = (cx - ring) << Chunk.rank, (cx + ring) << Chunk.rank
+                y1, y2 = (cy - ring) << Chunk.rank, (cy + ring) << Chunk.rank
+                slots = np.concatenate([self.candidates(x1, y1, x2, y1, type),
+                                        self.candidates(x1, y2, x2, y2, type),
+                                        self.candidates(x1, y1 + Chunk.size, x1, y2 - Chunk.size, type),
+                                        self.candidates(x2, y1 + Chunk.size, x2, y2 - Chunk.size, type)])
+
+            if len(slots) > 0:
+                dist = (self.xs[slots] - x) ** 2 + (self.ys[slots] - y) ** 2
+                idx = int(np.argmin(dist))
+                if best_dist is None or dist[idx] < best_dist:
+                    best_slot, best_dist = int(slots[idx]), float(dist[idx])
+
+            # Chunks of the next rings are at least `ring` chunks away
+            if best_dist is not None and best_dist <= (ring * Chunk.size) ** 2:
+                break
+
+        if best_slot is None or (max_radius is not None and best_dist > max_radius * max_radius):
+            return None
+
+        return Entity(self, best_slot)
@@ -0,0 +1,44 @@
+from threading import Thread
+from queue import Queue
+from yarl.schema import ChunkTable
+import sqlite3 as sql
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkPrefetcher(Thread):
+    """
+    Reads chunks ahead of time on a background thread
+    Requests carry the queue of the loader that made them, decoded chunks are handed back through it
+    """
+
+    def __init__(self, save_file, radius=2):
+        super().__init__(daemon=True)
+        self.save_file = save_file
+        self.radius = radius
+        self.requests = Queue()
+
+    def request(self, arrivals, level_id, cposes):
+        self.requests.put((arrivals, level_id, cposes))
+
+    def stop(self):
+        self.requests.put((None, None, None))
+
+    def run(self):
+        table = ChunkTable(self.save_file.reader())
+        while True:
+            arrivals, level_id, cposes = self.requests.get()
+            if arrivals is None:
+                break
+
+            try:
+                chunks = table.select_many(level_id=level_id,
+                                           positions=cposes)
+            except sql.Error:
+                logger.exception("Failed to prefetch %i chunks of level %s", len(cposes), level_id)
+                chunks = None
+
+            # Chunks set to None signal a failed request
+
+            arrivals.put((cposes, chunks))
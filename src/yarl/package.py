@@ -1,7 +1,8 @@
 import itertools
 import re
-from zipfile import ZipFile
-from yarl.util import base_dir, partial
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
+from concurrent.futures import ProcessPoolExecutor
+from yarl.util import base_dir, partial, hash_file
 import json
 import glob
 from collections import namedtuple
@@ -9,11 +10,309 @@ import os
 from os.path import join, isdir, basename, realpath, relpath
 from importlib.abc import *
 from importlib.machinery import ModuleSpec
+from importlib.util import MAGIC_NUMBER
+import hashlib
+import marshal
+import mmap
+import struct
+import sys
+import time
+import zlib
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+def pack_code(source, code):
+    """
+    Serializes a code object, the header binds it to the interpreter and to the source it was compiled from
+
+    :param source: source bytes
+    :param code: compiled code object
+    :return: bytecode blob
+    """
+    return MAGIC_NUMBER + hashlib.sha1(source).digest() + marshal.dumps(code)
+
+
+def unpack_code(data, source):
+    """
+    Inverse of `pack_code`
+
+    :param data: bytecode blob
+    :param source: current source bytes
+    :return: code object or None if the blob is stale
+    """
+    magic_size = len(MAGIC_NUMBER)
+    header_size = magic_size + hashlib.sha1().digest_size
+    if len(data) < header_size or data[:magic_size] != MAGIC_NUMBER:
+        return None
+
+    if data[magic_size:header_size] != hashlib.sha1(source).digest():
+        return None
+
+    try:
+        return marshal.loads(data[header_size:])
+    except (EOFError, ValueError, TypeError):
+        return None
+
+
+# signature, version, flags, method, time, date, crc32, compressed size, size, name length, extra length
+zip_local_header = struct.Struct('<4s5H3I2H')
+
+
+def read_leading_member(path, name):
+    """
+    Reads the first member of a zip file from its local header, without parsing the central directory
+
+    :param path: archive path
+    :param name: expected name of the first member
+    :return: member data or None if the first member is not `name` or cannot be read that way
+    """
+    with open(path, mode='rb') as fd:
+        header = fd.read(zip_local_header.size)
+        if len(header) < zip_local_header.size:
+            return None
+
+        signature, _, flags, method, _, _, crc, csize, _, name_len, extra_len = zip_local_header.unpack(header)
+        # Encrypted members and members followed by a data descriptor have no usable sizes here
+        if signature != b'PK\x03\x04' or flags & 0x09:
+            return None
+
+        if fd.read(name_len) != name.encode('utf-8'):
+            return None
+
+        fd.seek(extra_len, os.SEEK_CUR)
+        data = fd.read(csize)
+
+    if method == ZIP_DEFLATED:
+        data = zlib.decompress(data, -15)
+    elif method != ZIP_STORED:
+        return None
+
+    return data if zlib.crc32(data) == crc else None
+
+
+# A member to build, `func(*args)` produces its content in a worker process
+BuildJob = namedtuple('BuildJob', ['arcname', 'path', 'compress_type', 'func', 'args'])
+
+# A finished member, `payload` is already compressed with `compress_type`
+BuiltMember = namedtuple('BuiltMember', ['arcname', 'path', 'compress_type', 'crc', 'file_size', 'digest', 'payload'])
+
+# Settings shared by all manifests of a build
+BuildOptions = namedtuple('BuildOptions', ['archive_name', 'bytecode', 'optimize_png'])
+
+
+def read_file(path):
+    with open(path, mode='rb') as fd:
+        return fd.read()
+
+
+def read_source(path):
+    with open(path, mode='r') as fd:
+        return fd.read().encode('utf-8')
+
+
+def compile_source(path, filename):
+    source = read_source(path)
+    code = compile(source, filename, 'exec', dont_inherit=True)
+    return pack_code(source, code)
+
+
+png_signature = b'\x89PNG\r\n\x1a\n'
+
+
+def optimize_png(path):
+    """
+    Re-deflates the image data of a PNG at the highest compression level
+    The pixels are left untouched, the original file is kept if it is not larger
+    """
+    data = read_file(path)
+    if not data.startswith(png_signature):
+        return data
+
+    chunks = list()
+    image_data = list()
+    offset = len(png_signature)
+    while offset < len(data):
+        length, kind = struct.unpack_from('>I4s', data, offset)
+        body = data[offset + 8:offset + 8 + length]
+        if kind == b'IDAT':
+            # Consecutive IDAT chunks form a single zlib stream, it is replaced where the first one was
+            if len(image_data) == 0:
+                chunks.append((b'IDAT', None))
+            image_data.append(body)
+        else:
+            chunks.append((kind, body))
+        offset += 12 + length
+
+    try:
+        pixels = zlib.decompress(b''.join(image_data))
+    except zlib.error:
+        return data
+
+    packed = zlib.compress(pixels, 9)
+    optimized = [png_signature]
+    for kind, body in chunks:
+        if body is None:
+            body = packed
+        optimized.append(struct.pack('>I4s', len(body), kind) + body +
+                         struct.pack('>I', zlib.crc32(kind + body)))
+
+    optimized = b''.join(optimized)
+    return optimized if len(optimized) < len(data) else data
+
+
+def build_member(job):
+    """
+    Produces and compresses a member, runs in the worker processes
+    """
+    data = job.func(*job.args)
+    if job.compress_type == ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        payload = compressor.compress(data) + compressor.flush()
+    else:
+        payload = data
+
+    return BuiltMember(job.arcname, job.path, job.compress_type,
+                       zlib.crc32(data), len(data), hashlib.sha1(data).hexdigest(), payload)
+
+
+# Private state of `ZipFile` that `write_raw_member` relies on, present from CPython 3.5 to 3.13
+ZIPFILE_INTERNALS = ('_lock', 'fp', 'start_dir', 'filelist', 'NameToInfo', '_didModify')
+
+
+def write_member(archive, member):
+    """
+    Appends an already compressed member to an archive open for writing
+    Falls back to recompressing it through `ZipFile.open` if the zipfile internals changed
+    """
+    info = ZipInfo(member.arcname, date_time=time.localtime(os.stat(member.path).st_mtime)[:6])
+    info.external_attr = 0o644 << 16
+    info.compress_type = member.compress_type
+    info.CRC = member.crc
+    info.file_size = member.file_size
+    info.compress_size = len(member.payload)
+
+    if all(hasattr(archive, name) for name in ZIPFILE_INTERNALS):
+        write_raw_member(archive, info, member.payload)
+        return
+
+    logger.warning("Unsupported zipfile internals, recompressing %s", member.arcname)
+    data = member.payload
+    if member.compress_type == ZIP_DEFLATED:
+        data = zlib.decompress(data, -zlib.MAX_WBITS)
+
+    with archive.open(info, mode='w') as fd:
+        fd.write(data)
+
+
+def write_raw_member(archive, info, payload):
+    """
+    `ZipFile` has no public API to write a compressed payload as is, this mirrors what `ZipFile.open(mode='w')`
+    does on close, using only the attributes listed in `ZIPFILE_INTERNALS`
+    """
+    with archive._lock:
+        info.header_offset = archive.fp.tell()
+        archive.fp.write(info.FileHeader())
+        archive.fp.write(payload)
+        archive.start_dir = archive.fp.tell()
+        archive.filelist.append(info)
+        archive.NameToInfo[info.filename] = info
+        archive._didModify = True
+
+
+class BuildCache(object):
+    """
+    Remembers the inputs of every member of an archive between builds
+    Members whose input did not change are copied, still compressed, from the previous archive
+    """
+
+    def __init__(self, archive_name):
+        self.archive_name = archive_name
+        self.path = archive_name + '.cache'
+        self.entries = dict()
+        self.current = dict()
+        self.previous = None
+
+    def load(self):
+        if not os.path.exists(self.path) or not os.path.exists(self.archive_name):
+            return
+
+        with open(self.path, mode='r') as fd:
+            data = json.load(fd)
+
+        # Compiled members depend on the interpreter
+        if data.get('magic') != MAGIC_NUMBER.hex():
+            return
+
+        self.entries = data['entries']
+        self.previous = ZipFile(self.archive_name, mode='r')
+
+    def save(self):
+        with open(self.path, mode='w') as fd:
+            json.dump({'magic': MAGIC_NUMBER.hex(), 'entries': self.current}, fd)
+
+    def close(self):
+        if self.previous is not None:
+            self.previous.close()
+            self.previous = None
+
+    @staticmethod
+    def signature(job):
+        return "%s:%i:%r" % (job.func.__name__, job.compress_type, job.args)
+
+    def is_fresh(self, job):
+        """
+        Tells if the member built by a job can be copied from the previous archive
+        Inputs are only hashed when their size or modification time changed
+        """
+        entry = self.entries.get(job.arcname)
+        if entry is None or self.previous is None or job.arcname not in self.previous.NameToInfo:
+            return False
+
+        if entry['signature'] != BuildCache.signature(job):
+            return False
+
+        stat = os.stat(job.path)
+        if entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            return True
+
+        if entry['input'] == hash_file(job.path):
+            entry['mtime'], entry['size'] = stat.st_mtime_ns, stat.st_size
+            return True
+
+        return False
+
+    def member(self, job):
+        """
+        Reads the compressed member of a fresh job from the previous archive
+        """
+        info = self.previous.getinfo(job.arcname)
+        fp = self.previous.fp
+        fp.seek(info.header_offset)
+        header = zip_local_header.unpack(fp.read(zip_local_header.size))
+        name_len, extra_len = header[-2:]
+        fp.seek(name_len + extra_len, os.SEEK_CUR)
+        payload = fp.read(info.compress_size)
+
+        return BuiltMember(job.arcname, job.path, info.compress_type,
+                           info.CRC, info.file_size, self.entries[job.arcname]['digest'], payload)
+
+    def store(self, job, member, fresh):
+        if fresh:
+            self.current[job.arcname] = self.entries[job.arcname]
+            return
+
+        stat = os.stat(job.path)
+        self.current[job.arcname] = {
+            'signature': BuildCache.signature(job),
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'input': hash_file(job.path),
+            'digest': member.digest,
+        }
+
+
 class BaseManifest(object):
     def __init__(self, file):
         self.manifest_path = file
@@ -25,7 +324,10 @@ class BaseManifest(object):
     def index(self, index):
         raise NotImplementedError
 
-    def build(self, archive):
+    def jobs(self, options):
+        """
+        Lists the members to build into the archive
+        """
         raise NotImplementedError
 
 
@@ -56,9 +358,10 @@ class AssetsManifest(BaseManifest):
         for name, path in self.tilesets():
             index.add_item(PackageIndex.TILESET, name, path)
 
-    def build(self, archive):
+    def jobs(self, options):
+        func = optimize_png if options.optimize_png else read_file
         for name, path in self.tilesets():
-            archive.write(path, arcname=join('assets', name))
+            yield BuildJob(join('assets', name), path, ZIP_STORED, func, (path,))
 
 
 class SourcesManifest(BaseManifest):
@@ -80,7 +383,8 @@ class SourcesManifest(BaseManifest):
                 rel_path = join(subpath, node)
                 if isdir(real_path):
                     yield from walk_dir(real_path, rel_path)
-                else:
+                elif node.endswith('.py'):
+                    # Skips __pycache__ content and other stray files
                     yield (real_path, rel_path)
 
         for provides in self.provides:
@@ -99,11 +403,14 @@ class SourcesManifest(BaseManifest):
 
         index.add_item(PackageIndex.LOADER, self.name, self.bootstrap)
 
-    def build(self, archive):
+    def jobs(self, options):
         for name, ispkg, path in self.sources():
-            source = open(path, 'r').read()
-            archive.writestr(join('src', name),
-                             data=source)
+            yield BuildJob(join('src', name), path, ZIP_DEFLATED, read_source, (path,))
+
+            # Compiled code next to the sources, the loader uses it instead of compiling at startup
+            if options.bytecode:
+                filename = "<%s:%s>" % (options.archive_name, name)
+                yield BuildJob(join('bytecode', name), path, ZIP_DEFLATED, compile_source, (path, filename))
 
 
 class ResourcesManifest(BaseManifest):
@@ -127,9 +434,9 @@ class ResourcesManifest(BaseManifest):
         for name, file in self.resources():
             index.add_item(PackageIndex.RESOURCE, name, file)
 
-    def build(self, archive):
+    def jobs(self, options):
         for name, file in self.resources():
-            archive.write(file, arcname=name)
+            yield BuildJob(name, file, ZIP_STORED, read_file, (file,))
 
 
 class PackageIndex(object):
@@ -205,19 +512,76 @@ class PackageManifest(BaseManifest):
         for package in self.packages:
             package.index(index)
 
-    def build(self, archive):
+    def jobs(self, options):
         for package in self.packages:
             logger.info("Building %s" % relpath(package.manifest_path, self.base))
-            package.index(self.pkindex)
-            package.build(archive)
+            yield from package.jobs(options)
+
+    def build(self, archive, archive_name, bytecode=False, optimize_png=False, workers=None, cache=None):
+        """
+        Builds the members on a process pool, only the writes to the archive happen on this thread
+        `archive_name` is the final name of the archive, compiled modules refer to it
+        `workers=0` builds everything in the current process
+        With a `cache`, only the members whose input changed are built again
+        """
+        # The index goes first so loaders can read it without the central directory
+        self.index(self.pkindex)
+        archive.writestr('index.json', self.pkindex.json)
+
+        options = BuildOptions(archive_name, bytecode, optimize_png)
+        jobs = list(self.jobs(options))
+
+        fresh = set()
+        if cache is not None:
+            fresh = set(job.arcname for job in jobs if cache.is_fresh(job))
 
-        json = self.pkindex.json
-        archive.writestr('index.json', json)
+        pending = [job for job in jobs if job.arcname not in fresh]
+        executor = None
+        if workers == 0 or len(pending) == 0:
+            built = map(build_member, pending)
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            # Results come back in job order, the archive layout does not depend on scheduling
+            built = executor.map(build_member, pending, chunksize=8)
+
+        try:
+            for job in jobs:
+                if job.arcname in fresh:
+                    member = cache.member(job)
+                else:
+                    member = next(built)
+                    logger.info("Rebuilt %s", job.arcname)
 
-    def build_archive(self, archive_name):
+                write_member(archive, member)
+                if cache is not None:
+                    cache.store(job, member, job.arcname in fresh)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        logger.info("Built %i members, %i rebuilt and %i reused", len(jobs), len(pending), len(fresh))
+
+    def build_archive(self, archive_name, bytecode=False, optimize_png=False, workers=None, incremental=True):
         logger.info("Building manifest %s in %s" % (self.name, self.base))
-        with ZipFile(archive_name, mode='w') as archive:
-            self.build(archive)
+        cache = None
+        if incremental:
+            cache = BuildCache(archive_name)
+            cache.load()
+
+        # The previous archive is still read while the new one is written
+        build_name = archive_name + '.tmp'
+        try:
+            # Assets and resources are stored so they can be read in place, sources are compressed
+            with ZipFile(build_name, mode='w', compression=ZIP_STORED) as archive:
+                self.build(archive, archive_name, bytecode=bytecode, optimize_png=optimize_png,
+                           workers=workers, cache=cache)
+        finally:
+            if cache is not None:
+                cache.close()
+
+        os.replace(build_name, archive_name)
+        if cache is not None:
+            cache.save()
 
     def build_index(self):
         self.index(self.pkindex)
@@ -230,7 +594,8 @@ class BasePackage(object):
 
     def load(self):
         """
-        This method is responsible for loading the index and other necessary resources
+        This method is responsible for loading the index
+        Other resources are opened on first access
         """
         raise NotImplementedError
 
@@ -247,46 +612,203 @@ class BasePackage(object):
         """
         raise NotImplementedError
 
+    def view(self, name, kind):
+        """
+        Returns a read-only memoryview of the requested key, mapped from disk when possible
+        """
+        raise NotImplementedError
+
+    def size(self, name, kind):
+        """
+        Returns the size in bytes of the requested key
+        """
+        data, meta = self.view(name, kind)
+        return len(data)
+
+    def stream(self, name, kind, chunk_size=64 * 1024):
+        """
+        Yields the requested key in chunks of at most `chunk_size` bytes
+        """
+        data, meta = self.view(name, kind)
+        for offset in range(0, len(data), chunk_size):
+            yield data[offset:offset + chunk_size]
+
+    def read_code(self, name, source):
+        """
+        Returns the cached code object of a module or None when there is no valid cache entry
+        """
+        return None
+
+    def write_code(self, name, source, code):
+        """
+        Stores the compiled code object of a module, packages without a code cache ignore it
+        """
+        pass
+
 
 class ArchivePackage(BasePackage):
     def __init__(self, location):
         super().__init__(location)
-        self.archive = None
+        self._archive = None
+        self._mapping = None
+
+    @property
+    def archive(self):
+        """
+        The zip file is only opened, and its central directory parsed, when a member is first read
+        """
+        if self._archive is None:
+            logger.debug("Opening archive %s", self.location)
+            self._archive = ZipFile(self.location, mode='r')
+
+        return self._archive
 
     def load(self):
-        self.archive = ZipFile(self.location, mode='r')
+        index = read_leading_member(self.location, 'index.json')
+        if index is None:
+            # Archives built before the index was stored first
+            index = self.archive.read('index.json')
 
         # Decode and load index
-        index = self.archive.read('index.json').decode('utf-8')
-        self.index.load(index)
+        self.index.load(index.decode('utf-8'))
 
-    def read(self, name, kind):
+    @property
+    def mapping(self):
+        if self._mapping is None:
+            with open(self.location, mode='rb') as fd:
+                self._mapping = memoryview(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+
+        return self._mapping
+
+    def member(self, name, kind):
         try:
             arcname, meta = self.index.get_item(kind, name)
-            data = self.archive.open(arcname, mode='r')
-            return data.read(), meta
+            return self.archive.getinfo(arcname), meta
         except KeyError:
             raise KeyError("Key %s does not exist in package %s" % (name, self.location))
 
+    def member_view(self, info):
+        """
+        Maps a stored member straight from the archive, the data follows its local header
+        """
+        offset = info.header_offset
+        header = zip_local_header.unpack_from(self.mapping, offset)
+        name_len, extra_len = header[-2:]
+        start = offset + zip_local_header.size + name_len + extra_len
+        return self.mapping[start:start + info.file_size]
+
+    def read(self, name, kind):
+        info, meta = self.member(name, kind)
+        return self.archive.read(info), meta
+
+    def size(self, name, kind):
+        info, meta = self.member(name, kind)
+        return info.file_size
+
+    def view(self, name, kind):
+        info, meta = self.member(name, kind)
+        if info.compress_type == ZIP_STORED:
+            return self.member_view(info), meta
+
+        return memoryview(self.archive.read(info)), meta
+
+    def stream(self, name, kind, chunk_size=64 * 1024):
+        info, meta = self.member(name, kind)
+        if info.compress_type == ZIP_STORED:
+            yield from super().stream(name, kind, chunk_size)
+            return
+
+        # Compressed members are inflated chunk by chunk
+        with self.archive.open(info, mode='r') as data:
+            chunk = data.read(chunk_size)
+            while len(chunk) > 0:
+                yield chunk
+                chunk = data.read(chunk_size)
+
+    def read_code(self, name, source):
+        arcname = 'bytecode/%s' % name
+        if arcname not in self.archive.NameToInfo:
+            return None
+
+        return unpack_code(self.archive.read(arcname), source)
+
 
 class DirectoryPackage(BasePackage):
+    """
+    Package read straight from a manifest
+    Compiled modules are cached in a __pycache__ directory next to the manifest
+    """
+
+    def __init__(self, location):
+        super().__init__(location)
+        self.cache_dir = join(base_dir(location), '__pycache__')
+
     def load(self):
         manifest = PackageManifest(self.location)
         manifest.index(self.index)
 
-    def read(self, name, kind):
+    def code_path(self, name):
+        return join(self.cache_dir, "%s.%s.pyc" % (name, sys.implementation.cache_tag))
+
+    def read_code(self, name, source):
         try:
-            path, meta = self.index.get_item(kind, name)
-            data = open(path, mode='rb')
-            return data.read(), meta
+            with open(self.code_path(name), mode='rb') as fd:
+                return unpack_code(fd.read(), source)
+        except OSError:
+            return None
+
+    def write_code(self, name, source, code):
+        if sys.dont_write_bytecode:
+            return
+
+        path = self.code_path(name)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write then rename so a concurrent reader never sees a partial file
+            tmp_path = "%s.%i.tmp" % (path, os.getpid())
+            with open(tmp_path, mode='wb') as fd:
+                fd.write(pack_code(source, code))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.debug("Could not cache bytecode of %s: %s", name, e)
+
+    def path(self, name, kind):
+        try:
+            return self.index.get_item(kind, name)
         except KeyError:
             raise KeyError("Key %s does not exist in package %s" % (name, self.location))
 
+    def read(self, name, kind):
+        path, meta = self.path(name, kind)
+        with open(path, mode='rb') as data:
+            return data.read(), meta
+
+    def size(self, name, kind):
+        path, meta = self.path(name, kind)
+        return os.path.getsize(path)
+
+    def view(self, name, kind):
+        path, meta = self.path(name, kind)
+        with open(path, mode='rb') as data:
+            if os.fstat(data.fileno()).st_size == 0:
+                # Empty files cannot be mapped
+                return memoryview(b''), meta
+
+            return memoryview(mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)), meta
+
 
 class PackageLoader(object):
+    """
+    Loads the package indexes and merges them in a single lookup table
+    Packages are listed from lowest to highest priority, an entry of a later package overrides earlier ones
+    Loaders are not merged, the loaders of every package run in load order
+    """
+
     def __init__(self, packages):
         self.packages = dict.fromkeys(packages)
         self.class_loader = PackagedClassLoader(self)
+        # Maps each entry to the package providing it
+        self.index = {category: dict() for category in PackageIndex.CATEGORIES}
 
     def load(self):
         """
@@ -301,22 +823,79 @@ class PackageLoader(object):
             else:
                 raise RuntimeError("Unhandled package type for %s" % name)
 
+            start = time.perf_counter()
             package.load()
+            self.merge(package)
+            logger.info("Indexed %s in %.2fms", name, (time.perf_counter() - start) * 1000)
+
             self.packages[name] = package
 
-        self.class_loader.build()
+    def merge(self, package):
+        for category in PackageIndex.CATEGORIES:
+            if category == PackageIndex.LOADER:
+                # Loader entries are named after the sources manifest, packs would hide each other's
+                continue
+
+            pool = self.index[category]
+            for entry, _ in package.index.get_all(category):
+                if entry in pool:
+                    logger.debug("%s %s from %s overrides %s", category, entry, package.location, pool[entry].location)
+
+                pool[entry] = package
+
+    def lookup(self, name, kind):
+        """
+        Finds the package providing an entry
+        """
+        pool = self.index[kind]
+        if name not in pool:
+            raise KeyError("Key %s (%s) does not exist in any package" % (name, kind))
+
+        return pool[name]
+
+    def contains(self, name, kind):
+        return name in self.index[kind]
+
+    def get(self, name, kind):
+        return self.lookup(name, kind).get(name, kind)
+
+    def read(self, name, kind):
+        return self.lookup(name, kind).read(name, kind)
+
+    def view(self, name, kind):
+        return self.lookup(name, kind).view(name, kind)
+
+    def size(self, name, kind):
+        return self.lookup(name, kind).size(name, kind)
+
+    def stream(self, name, kind, chunk_size=64 * 1024):
+        return self.lookup(name, kind).stream(name, kind, chunk_size)
+
+    def providers(self, kind):
+        """
+        Lists entries with the package providing them, loaders are listed for every package in load order
+        """
+        if kind == PackageIndex.LOADER:
+            for package in self.packages.values():
+                for entry, _ in package.index.get_all(kind):
+                    yield entry, package
+        else:
+            yield from self.index[kind].items()
+
+    def get_all(self, kind):
+        for name, package in self.providers(kind):
+            yield name, package.get(name, kind)
 
     def get_from_module(self, name):
         return self.class_loader.get_package(name)
 
     def dump(self):
         logger.debug("PackageLoader dump")
-        for name, pkg in self.packages.items():
-            logger.debug("  Package %s (%s)", name, type(pkg).__name__)
-            for cat in PackageIndex.CATEGORIES:
-                logger.debug("    = %s =", cat)
-                for entry, (data, meta) in pkg.index.get_all(cat):
-                    logger.debug("    - %s: %s %s", entry, data, repr(meta))
+        for cat in PackageIndex.CATEGORIES:
+            logger.debug("  = %s =", cat)
+            for entry, package in self.providers(cat):
+                data, meta = package.get(entry, cat)
+                logger.debug("  - %s: %s %s (%s)", entry, data, repr(meta), package.location)
 
     def hook(self):
         """
@@ -337,19 +916,10 @@ class PackagedClassLoader(MetaPathFinder, ExecutionLoader):
 
     def __init__(self, loader):
         self.loader = loader
-        self.modules = dict()
-
-    def build(self):
-        """
-        Build the package index to allow for fast lookup
-        """
-        for pkname, package in self.loader.packages.items():
-            for module, _ in package.index.get_all(PackageIndex.MODULE):
-                self.modules[module] = package
 
     def find_spec(self, fullname, path, target=None):
         logger.debug("Lookup for %s", fullname)
-        if fullname in self.modules:
+        if self.loader.contains(fullname, PackageIndex.MODULE):
             return ModuleSpec(fullname, self, is_package=self.is_package(fullname))
         else:
             return None
@@ -359,6 +929,21 @@ class PackagedClassLoader(MetaPathFinder, ExecutionLoader):
         source, meta = package.read(fullname, PackageIndex.MODULE)
         return source
 
+    def get_code(self, fullname):
+        """
+        Uses the package bytecode cache when it matches the source, compiles and stores it otherwise
+        """
+        package = self.get_package(fullname)
+        source, meta = package.read(fullname, PackageIndex.MODULE)
+
+        code = package.read_code(fullname, source)
+        if code is None:
+            logger.debug("Compiling %s", fullname)
+            code = self.source_to_code(source, self.get_filename(fullname))
+            package.write_code(fullname, source, code)
+
+        return code
+
     def get_filename(self, fullname):
         package = self.get_package(fullname)
         return "<%s:%s>" % (package.location, fullname)
@@ -372,4 +957,4 @@ class PackagedClassLoader(MetaPathFinder, ExecutionLoader):
         return is_package
 
     def get_package(self, fullname):
-        return self.modules[fullname]
+        return self.loader.lookup(fullname, PackageIndex.MODULE)
@@ -2,9 +2,19 @@ import sqlite3 as sql
 from sfml import sf
 from yarl.block import BlockRegistry
 from yarl.map.chunk import TileMatrix
+from yarl.map.entity import EntityList
 from yarl.util import dump_vec2, load_vec2
-from yarl.schema import SaveSchema
+from yarl.schema import SaveSchema, WorldTable, RegionTable, LevelTable
+from yarl.session import Session
 from yarl.map import World, Region, Level
+from yarl.map.prefetch import ChunkPrefetcher
+from yarl.autosave import SaveSnapshot, SaveWriter
+from yarl.service import Service
+from queue import Empty
+from threading import Lock, local
+import logging
+
+logger = logging.getLogger(__name__)
 
 sql.register_adapter(sf.Vector2, dump_vec2)
 sql.register_converter("vector2", load_vec2)
@@ -12,23 +22,115 @@ sql.register_converter("vector2", load_vec2)
 sql.register_adapter(TileMatrix, TileMatrix.pack)
 sql.register_converter("tilematrix", TileMatrix.unpack)
 
+sql.register_adapter(EntityList, EntityList.pack)
+sql.register_converter("entitylist", EntityList.unpack)
+
 
 class SaveFile(object):
-    def __init__(self, fpath, world_id):
+    """
+    The game thread writes through `conn`, background threads read through their own `reader()` connection
+    Connections run in WAL mode so readers never block on, nor are blocked by, the writer
+    """
+
+    message_bus = Service('engine.message_bus')
+
+    # Applied to every connection, entries of the `pragmas` argument override them
+    default_pragmas = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -8 * 1024,
+        'mmap_size': 64 * 1024 * 1024,
+    }
+
+    def __init__(self, fpath, world_id, max_chunks=256, max_bytes=None, prefetch_radius=None,
+                 pragmas=None, cached_statements=256):
         self.path = fpath
         self.id = world_id
+        self.chunk_budget = dict(max_chunks=max_chunks,
+                                 max_bytes=max_bytes)
+        self.prefetch_radius = prefetch_radius
+        self.prefetcher = None
+        self.writer = None
+        self.in_flight = None
+        self.pragmas = dict(self.default_pragmas)
+        self.pragmas.update(pragmas or {})
+        self.cached_statements = cached_statements
+        self.local = local()
+        self.readers = list()
+        self.readers_lock = Lock()
+        self.session = None
         self.conn = None
         self.schema = None
         self.world = None
         self.is_open = False
 
+    def connect(self, readonly=False):
+        """
+        Opens a new connection to the save file, connections can not be shared between threads
+        Each connection keeps its prepared statements, up to `cached_statements` of them
+        """
+        # Pooled readers are closed by the game thread, they are still only used by the thread that opened them
+        conn = sql.connect(self.path,
+                           detect_types=sql.PARSE_DECLTYPES,
+                           cached_statements=self.cached_statements,
+                           check_same_thread=not readonly)
+        conn.row_factory = sql.Row
+
+        for name, value in self.pragmas.items():
+            conn.execute("PRAGMA %s = %s" % (name, value))
+
+        if readonly:
+            conn.execute("PRAGMA query_only = ON")
+
+        return conn
+
+    def reader(self):
+        """
+        Read-only connection of the calling thread, opened on first use and closed with the save file
+        """
+        conn = getattr(self.local, 'reader', None)
+        if conn is None:
+            conn = self.connect(readonly=True)
+            self.local.reader = conn
+            with self.readers_lock:
+                self.readers.append(conn)
+
+        return conn
+
     def open(self):
-        self.conn = sql.connect(self.path, detect_types=sql.PARSE_DECLTYPES)
-        self.conn.row_factory = sql.Row
-        self.schema = SaveSchema(self.conn, 1.0)
+        self.conn = self.connect()
+        self.session = Session(self.conn, SaveSchema.tables)
+        self.schema = SaveSchema(self.conn)
         self.is_open = True
 
+        if self.has_schema():
+            self.schema.migrate()
+
+        if self.prefetch_radius is not None:
+            self.prefetcher = ChunkPrefetcher(save_file=self,
+                                              radius=self.prefetch_radius)
+            self.prefetcher.start()
+
     def close(self):
+        if self.writer is not None:
+            self.wait()
+            self.writer.stop()
+            self.writer.join()
+            self.writer = None
+
+        # Chunks evicted since the last save are only queued
+        self.session.flush()
+
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher.join()
+            self.prefetcher = None
+
+        with self.readers_lock:
+            for conn in self.readers:
+                conn.close()
+            self.readers = list()
+
         self.conn.close()
 
     def has_schema(self):
@@ -36,8 +138,7 @@ class SaveFile(object):
             raise RuntimeError("Save file not opened")
 
         try:
-            res = map(lambda row: row[0],
-                      self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+            res = [row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
 
             return self.schema.is_valid(res)
         except sql.DatabaseError:
@@ -51,25 +152,105 @@ class SaveFile(object):
         self.schema.create()
 
     def save(self):
+        """
+        Saves the world, returns the number of chunks written
+        """
         if not self.is_open:
             raise RuntimeError("Save file not opened")
 
         if not self.has_schema():
             self.init()
 
+        # Never let an older snapshot land after this save
+        self.wait()
+
+        written = 0
         self.world.save()
         for n1, region in self.world.regions.items():
             region.save()
             for n2, level in region.levels.items():
-                level.save()
+                written += level.save()
 
-        self.conn.commit()
+        self.session.flush()
+
+        return written
+
+    def save_async(self):
+        """
+        Snapshots the modified state and hands it to the writer thread, returns the number of chunks to write
+        Completion is reported by `poll` through the "save.complete" and "save.failed" events
+        Returns None when the previous save is still being written
+        """
+        if not self.is_open:
+            raise RuntimeError("Save file not opened")
+
+        if self.in_flight is not None:
+            logger.info("Autosave skipped, %s is still being written", self.in_flight)
+            return None
+
+        if not self.has_schema():
+            self.init()
+
+        if self.writer is None:
+            self.writer = SaveWriter(save_file=self)
+            self.writer.start()
+
+        self.in_flight = SaveSnapshot(self.world)
+        # Rows created while taking the snapshot must exist before the writer updates them
+        self.session.flush()
+        self.writer.request(self.in_flight)
+
+        return self.in_flight.chunk_count
+
+    def poll(self):
+        """
+        Reports a finished asynchronous save, must be called from the game thread
+        """
+        if self.in_flight is None:
+            return
+
+        try:
+            snapshot = self.writer.results.get_nowait()
+        except Empty:
+            return
+
+        self.finish(snapshot)
+
+    def wait(self):
+        """
+        Blocks until the asynchronous save in progress, if any, is written and reported
+        """
+        if self.in_flight is not None:
+            self.finish(self.writer.results.get())
+
+    def finish(self, snapshot):
+        self.in_flight = None
+        snapshot.release()
+
+        if snapshot.error is None:
+            logger.info("Saved %i chunks in %.2fms", snapshot.chunk_count, snapshot.elapsed * 1000)
+            self.message_bus.emit('save.complete', snapshot, source='engine.save_file')
+        else:
+            self.message_bus.emit('save.failed', snapshot, source='engine.save_file')
 
     def upsert(self, table, obj):
-        table(self.conn).upsert(obj)
+        """
+        Queues the write of an object, it happens on the next `save` or when the session queue fills up
+        """
+        self.session.add(table, obj)
+
+    def upsert_many(self, table, objs):
+        self.session.add_many(table, objs)
+        return len(objs)
+
+    def insert_many(self, table, objs):
+        self.session.add_many(table, objs)
 
     def select(self, table, **kwargs):
-        return table(self.conn).select(**kwargs)
+        return self.session.select(table, **kwargs)
+
+    def select_many(self, table, **kwargs):
+        return self.session.select_many(table, **kwargs)
 
     def load(self):
         if not self.is_open:
@@ -89,12 +270,17 @@ class SaveFile(object):
             self.conn.commit()
         else:
             registry.load_map(row['data_val'])
+            # Blocks added by packs loaded after the world was created
+            if registry.build_map() > 0:
+                self.schema.set_meta('block_mappings', registry.save_map())
+                self.conn.commit()
 
         res = self.conn.execute("SELECT * FROM worlds WHERE id = ?", (self.id,))
         row = res.fetchone()
         world = World(name=row['name'],
                       save_file=self)
         world.id = row['id']
+        self.session.register(WorldTable, world)
         world.regions = self.load_regions(self.id)
 
         self.world = world
@@ -108,6 +294,7 @@ class SaveFile(object):
                             world_id=world_id,
                             save_file=self)
             region.id = row['id']
+            self.session.register(RegionTable, region)
             region.levels = self.load_levels(region.id)
             regions[region.name] = region
 
@@ -122,6 +309,8 @@ class SaveFile(object):
                           region_id=region_id,
                           save_file=self)
             level.id = row['id']
+            level.next_entity_id = row['next_entity_id']
+            self.session.register(LevelTable, level)
             levels[level.name] = level
 
         return levels
@@ -133,6 +322,7 @@ class SaveFile(object):
         if not self.has_schema():
             self.init()
 
+        self.session.clear()
         self.schema.clear()
         self.conn.execute("INSERT INTO worlds(id, name) VALUES(0, ?)", (name,))
         self.conn.commit()
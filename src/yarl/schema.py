@@ -1,38 +1,104 @@
 import sqlite3 as sql
+from sfml import sf
+from yarl.util import pack_key, unpack_key
+import pickle
+import json
 
 
 class SchemaTable(object):
+    # Tuples of (name, columns, unique)
+    indexes = ()
+
     def __init__(self, conn):
         self.conn = conn
 
+    @classmethod
+    def ddl(cls):
+        fields = ", ".join(map(lambda field: " ".join(field), cls.fields))
+        return "CREATE TABLE %s (%s)" % (cls.table_name, fields)
+
+    @classmethod
+    def insert_row_sql(cls):
+        """
+        Insert statement including the id column, for rows whose id is allocated by the session
+        """
+        names = [name for name, _ in cls.fields]
+        return "INSERT INTO %s(%s) VALUES (%s)" % (cls.table_name, ", ".join(names),
+                                                   ", ".join(":" + name for name in names))
+
+    @classmethod
+    def natural_key(cls, obj):
+        """
+        Identifies an object by its content, for rows that can be looked up without their id
+        """
+        return None
+
+    @classmethod
+    def lookup_key(cls, **kwargs):
+        """
+        Natural key matching the arguments of `select`
+        """
+        return None
+
     def create(self):
-        klass = type(self)
-        fields = ", ".join(map(lambda field: " ".join(field), klass.fields))
-        ddl_stmt = "CREATE TABLE %s (%s)" % (klass.table_name, fields)
+        ddl_stmt = type(self).ddl()
         print(ddl_stmt)
         try:
             with self.conn:
                 self.conn.execute(ddl_stmt)
+                self.create_indexes()
             return True
         except sql.DatabaseError:
             return False
 
+    def create_indexes(self):
+        klass = type(self)
+        for name, columns, unique in klass.indexes:
+            ddl_stmt = "CREATE %s INDEX %s ON %s (%s)" % ("UNIQUE" if unique else "", name, klass.table_name, columns)
+            print(ddl_stmt)
+            self.conn.execute(ddl_stmt)
+
     def select(self, **kwargs):
         raise RuntimeError("Table %s does not implement SELECT" % type(self))
 
+    def select_many(self, **kwargs):
+        raise RuntimeError("Table %s does not implement bulk SELECT" % type(self))
+
     def upsert(self, obj):
         func = self.insert if obj.id is None else self.update
         with self.conn:
             func(obj)
 
+    def upsert_many(self, objs):
+        """
+        Writes several objects in a single transaction
+        Updates are grouped in one `executemany`, returns the number of written objects
+        """
+        inserts = [obj for obj in objs if obj.id is None]
+        updates = [self.params(obj) for obj in objs if obj.id is not None]
+        with self.conn:
+            for obj in inserts:
+                self.insert(obj)
+
+            if len(updates) > 0:
+                self.conn.executemany(type(self).update_sql, updates)
+
+        return len(inserts) + len(updates)
+
     def update(self, obj):
-        self.conn.execute(type(self).update_sql, obj.__dict__)
+        self.conn.execute(type(self).update_sql, self.params(obj))
 
     def insert(self, obj):
         cur = self.conn.cursor()
-        cur.execute(type(self).insert_sql, obj.__dict__)
+        cur.execute(type(self).insert_sql, self.params(obj))
         obj.id = cur.lastrowid
 
+    def params(self, obj):
+        """
+        Maps an object to the named parameters of the insert and update statements
+        """
+        return obj.__dict__
+
 
 class MetaTable(SchemaTable):
     table_name = 'metadata'
@@ -103,11 +169,14 @@ class LevelTable(SchemaTable):
         ('id', 'INTEGER PRIMARY KEY'),
         ('region_id', 'INTEGER'),
         ('name', 'VARCHAR(128)'),
-        ('size', 'vector2')
+        ('size', 'vector2'),
+        ('next_entity_id', 'INTEGER DEFAULT 1')
     )
 
-    update_sql = "UPDATE levels SET region_id = :region_id, name = :name, size = :size WHERE id = :id"
-    insert_sql = "INSERT INTO levels(region_id, name, size) VALUES (:region_id, :name, :size)"
+    update_sql = ("UPDATE levels SET region_id = :region_id, name = :name, size = :size, "
+                  "next_entity_id = :next_entity_id WHERE id = :id")
+    insert_sql = ("INSERT INTO levels(region_id, name, size, next_entity_id) "
+                  "VALUES (:region_id, :name, :size, :next_entity_id)")
 
 
 class ChunkTable(SchemaTable):
@@ -116,56 +185,103 @@ class ChunkTable(SchemaTable):
     fields = (
         ('id', 'INTEGER PRIMARY KEY'),
         ('level_id', 'INTEGER'),
-        ('pos', 'vector2'),
-        ('tiles', 'tilematrix')
+        ('cx', 'INTEGER'),
+        ('cy', 'INTEGER'),
+        ('tiles', 'tilematrix'),
+        ('entities', 'entitylist')
+    )
+    indexes = (
+        ('chunks_position', 'level_id, cx, cy', True),
     )
 
-    update_sql = "UPDATE chunks SET level_id = :level_id, pos = :pos, tiles = :tiles WHERE id = :id"
-    insert_sql = "INSERT INTO chunks(level_id, pos, tiles) VALUES (:level_id, :pos, :tiles)"
+    update_sql = ("UPDATE chunks SET level_id = :level_id, cx = :cx, cy = :cy, tiles = :tiles, entities = :entities "
+                  "WHERE id = :id")
+    insert_sql = ("INSERT INTO chunks(level_id, cx, cy, tiles, entities) "
+                  "VALUES (:level_id, :cx, :cy, :tiles, :entities)")
+
+    @classmethod
+    def natural_key(cls, chunk):
+        return chunk.level_id, pack_key(chunk.pos.x, chunk.pos.y)
+
+    @classmethod
+    def lookup_key(cls, level_id=None, pos=None, **kwargs):
+        if level_id is None or pos is None:
+            return None
+
+        return level_id, pack_key(pos.x, pos.y)
+
+    def params(self, chunk):
+        return dict(id=chunk.id,
+                    level_id=chunk.level_id,
+                    cx=chunk.pos.x,
+                    cy=chunk.pos.y,
+                    tiles=chunk.tiles,
+                    entities=chunk.entities)
 
     def select(self, **kwargs):
         from yarl.map.chunk import Chunk
 
         with self.conn:
             cur = self.conn.cursor()
-            cur.execute("SELECT * FROM chunks WHERE level_id = :level_id AND pos = :pos", kwargs)
+            cur.execute("SELECT * FROM chunks WHERE level_id = ? AND cx = ? AND cy = ?",
+                        (kwargs['level_id'], kwargs['pos'].x, kwargs['pos'].y))
             row = cur.fetchone()
             if row is None:
                 return None
 
-            chunk = Chunk(kwargs['level_id'], row['pos'], row['tiles'])
+            chunk = Chunk(kwargs['level_id'], sf.Vector2(row['cx'], row['cy']), row['tiles'], row['entities'])
             chunk.id = row['id']
             return chunk
 
+    def select_many(self, level_id, positions):
+        """
+        Selects the chunks at the given positions with a single range query over their bounding box
+        """
+        from yarl.map.chunk import Chunk
 
-class EntityTable(SchemaTable):
-    table_name = 'entities'
-    depends = ['levels']
-    fields = (
-        ('id', 'INTEGER PRIMARY KEY'),
-        ('level_id', 'INTEGER'),
-        ('type', 'VARCHAR(128)'),
-        ('pos', 'vector2'),
-        ('data', 'pickle')
-    )
+        positions = list(positions)
+        if len(positions) == 0:
+            return []
+
+        wanted = set(pack_key(pos.x, pos.y) for pos in positions)
+        chunks = list()
+        for row in self.select_box(level_id, positions, "*"):
+            if pack_key(row['cx'], row['cy']) in wanted:
+                chunk = Chunk(level_id, sf.Vector2(row['cx'], row['cy']), row['tiles'], row['entities'])
+                chunk.id = row['id']
+                chunks.append(chunk)
+
+        return chunks
 
-    update_sql = "UPDATE entities SET level_id = :level_id, type = :type, pos = :pos, data = :data WHERE id = :id"
-    insert_sql = "INSERT INTO entities(level_id, type, pos, data) VALUES (:level_id, :type, :pos, :data)"
+    def select_box(self, level_id, positions, columns):
+        xs = [pos.x for pos in positions]
+        ys = [pos.y for pos in positions]
+        return self.conn.execute("SELECT %s FROM chunks "
+                                 "WHERE level_id = ? AND cx BETWEEN ? AND ? AND cy BETWEEN ? AND ?" % columns,
+                                 (level_id, min(xs), max(xs), min(ys), max(ys)))
 
 
 class SaveSchema(object):
+    version = 3
+
     tables = [
         MetaTable,
         WorldTable,
         RegionTable,
         LevelTable,
         ChunkTable,
-        EntityTable,
     ]
 
-    def __init__(self, conn, version):
+    def __init__(self, conn, version=None):
         self.conn = conn
-        self.version = version
+        if version is not None:
+            self.version = version
+
+        # Maps a version to the function upgrading from it
+        self.migrations = {
+            1: self.migrate_chunk_coordinates,
+            2: self.migrate_entities,
+        }
 
     def is_valid(self, db_tables):
         schema_tables = map(lambda t: t.table_name, type(self).tables)
@@ -176,11 +292,117 @@ class SaveSchema(object):
 
         return True
 
+    def get_meta(self, key):
+        row = self.conn.execute("SELECT data_val FROM metadata WHERE data_key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO metadata(data_key, data_val) VALUES (?, ?)", (key, value))
+
+    def current_version(self):
+        version = self.get_meta('schema_version')
+        if version is not None:
+            return int(version)
+
+        # Saves created before versioning, the chunks table tells them apart
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(chunks)")]
+        return 2 if 'cx' in columns else 1
+
+    def migrate(self):
+        """
+        Upgrades the schema in place to the current version
+        """
+        version = self.current_version()
+        while version < self.version:
+            print("Migrating schema from version %i" % version)
+            self.conn.execute("BEGIN")
+            try:
+                self.migrations[version]()
+                version += 1
+                self.set_meta('schema_version', str(version))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def migrate_chunk_coordinates(self):
+        """
+        Version 2 stores chunk positions as indexed integer columns instead of "x;y" vectors
+        """
+        self.conn.execute("ALTER TABLE chunks RENAME TO chunks_v1")
+        self.conn.execute(ChunkTable.ddl())
+        ChunkTable(self.conn).create_indexes()
+        self.conn.execute("INSERT OR REPLACE INTO chunks(id, level_id, cx, cy, tiles) "
+                          "SELECT id, level_id, "
+                          "CAST(substr(pos, 1, instr(pos, ';') - 1) AS INTEGER), "
+                          "CAST(substr(pos, instr(pos, ';') + 1) AS INTEGER), "
+                          "tiles FROM chunks_v1 ORDER BY id")
+        self.conn.execute("DROP TABLE chunks_v1")
+
+    def columns(self, table_name):
+        return [row[1] for row in self.conn.execute("PRAGMA table_info(%s)" % table_name)]
+
+    def migrate_entities(self):
+        """
+        Version 3 stores entities with their chunk, in a structured entity list instead of one pickled row each
+        """
+        from yarl.map.entity import EntityStore
+
+        # Saves migrated from version 1 already have the columns of the current chunks table
+        if 'entities' not in self.columns('chunks'):
+            self.conn.execute("ALTER TABLE chunks ADD COLUMN entities entitylist")
+        if 'next_entity_id' not in self.columns('levels'):
+            self.conn.execute("ALTER TABLE levels ADD COLUMN next_entity_id INTEGER DEFAULT 1")
+
+        tables = [row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        if 'entities' not in tables:
+            return
+
+        stores = dict()
+        rows = self.conn.execute("SELECT id, level_id, type, "
+                                 "CAST(substr(pos, 1, instr(pos, ';') - 1) AS INTEGER), "
+                                 "CAST(substr(pos, instr(pos, ';') + 1) AS INTEGER), "
+                                 "CAST(data AS BLOB) FROM entities ORDER BY id")
+        for entity_id, level_id, entity_type, x, y, data in rows.fetchall():
+            try:
+                meta = pickle.loads(data) if data is not None else None
+            except Exception:
+                # Unpickling fails when the data refers to classes that no longer exist
+                print("Dropping data of entity %i, it can not be unpickled" % entity_id)
+                meta = None
+
+            if meta is not None and not isinstance(meta, dict):
+                meta = dict(data=meta)
+
+            try:
+                json.dumps(meta)
+            except (TypeError, ValueError):
+                print("Dropping data of entity %i, it can not be stored as JSON" % entity_id)
+                meta = None
+
+            store = stores.setdefault(level_id, EntityStore())
+            store.spawn(entity_type, x, y, meta, entity_id)
+
+        for level_id, store in stores.items():
+            self.conn.execute("UPDATE levels SET next_entity_id = ? WHERE id = ?", (store.next_id, level_id))
+            for key in store.buckets:
+                cx, cy = unpack_key(key)
+                entities = store.pack(key).pack()
+                cur = self.conn.execute("UPDATE chunks SET entities = ? WHERE level_id = ? AND cx = ? AND cy = ?",
+                                        (entities, level_id, cx, cy))
+                if cur.rowcount == 0:
+                    # Chunks without tiles are filled with void when loaded
+                    self.conn.execute("INSERT INTO chunks(level_id, cx, cy, entities) VALUES (?, ?, ?, ?)",
+                                      (level_id, cx, cy, entities))
+
+        self.conn.execute("DROP TABLE entities")
+
     def clear(self):
         tables = type(self).tables
         for table in tables:
             self.conn.execute("DELETE FROM %s" % table.table_name)
 
+        self.set_meta('schema_version', str(self.version))
         self.conn.commit()
 
     def create(self):
@@ -190,4 +412,5 @@ class SaveSchema(object):
             table_obj = table(self.conn)
             table_obj.create()
 
+        self.set_meta('schema_version', str(self.version))
         self.conn.commit()
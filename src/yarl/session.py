@@ -0,0 +1,186 @@
+from collections import OrderedDict
+from weakref import WeakValueDictionary
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Session(object):
+    """
+    Unit of work over the game thread connection
+
+    Keeps an identity map so a row is represented by a single live object, and queues writes instead of
+    running one transaction per object. `flush` writes the queue in one transaction, with at most one
+    `executemany` per table for inserts and one for updates.
+    Ids are allocated client-side, new objects get theirs as soon as they are added.
+    """
+
+    def __init__(self, conn, tables, flush_threshold=512):
+        self.conn = conn
+        # Flush order, referenced tables first
+        self.tables = list(tables)
+        self.flush_threshold = flush_threshold
+        self.next_ids = dict()
+        # Number of flushes so far, readers on other connections use it to detect stale reads
+        self.flushes = 0
+        self.wrappers = dict()
+        # Weak maps, rows that are neither queued nor used elsewhere are forgotten
+        self.identity = WeakValueDictionary()
+        self.natural = WeakValueDictionary()
+        # Queued writes per table, keyed by id so an object is written once per flush
+        self.inserts = {table: OrderedDict() for table in self.tables}
+        self.updates = {table: OrderedDict() for table in self.tables}
+
+    def __repr__(self):
+        return "Session{ objects=%i, pending=%i }" % (len(self.identity), self.pending)
+
+    @property
+    def pending(self):
+        return sum(len(queue) for queue in self.inserts.values()) + sum(len(queue) for queue in self.updates.values())
+
+    def table(self, table):
+        """
+        Table wrapper bound to the session connection, created once per table
+        """
+        table_obj = self.wrappers.get(table)
+        if table_obj is None:
+            table_obj = table(self.conn)
+            self.wrappers[table] = table_obj
+
+        return table_obj
+
+    def allocate(self, table):
+        next_id = self.next_ids.get(table)
+        if next_id is None:
+            row = self.conn.execute("SELECT coalesce(max(id), 0) FROM %s" % table.table_name).fetchone()
+            next_id = row[0] + 1
+
+        self.next_ids[table] = next_id + 1
+        return next_id
+
+    def register(self, table, obj):
+        self.identity[(table, obj.id)] = obj
+        key = table.natural_key(obj)
+        if key is not None:
+            self.natural[(table, key)] = obj
+
+    def get(self, table, obj_id):
+        return self.identity.get((table, obj_id))
+
+    def lookup(self, table, key):
+        return self.natural.get((table, key))
+
+    def merge(self, table, obj):
+        """
+        Returns the live object of the row `obj` was read from, registers `obj` if there is none
+        """
+        key = table.natural_key(obj)
+        live = self.identity.get((table, obj.id)) if obj.id is not None else None
+        if live is None and key is not None:
+            live = self.natural.get((table, key))
+
+        if live is not None:
+            return live
+
+        if obj.id is not None:
+            self.register(table, obj)
+
+        return obj
+
+    def queue(self, table, obj):
+        if obj.id is None:
+            obj.id = self.allocate(table)
+            self.inserts[table][obj.id] = obj
+        elif obj.id not in self.inserts[table]:
+            self.updates[table][obj.id] = obj
+
+        self.register(table, obj)
+
+    def add(self, table, obj):
+        """
+        Queues the insert of a new object or the update of a known one
+        The queue is flushed once it holds `flush_threshold` objects
+        """
+        self.queue(table, obj)
+        if self.pending >= self.flush_threshold:
+            self.flush()
+
+    def add_many(self, table, objs):
+        """
+        Queues several objects, a batch is never split across transactions
+        """
+        for obj in objs:
+            self.queue(table, obj)
+
+        if self.pending >= self.flush_threshold:
+            self.flush()
+
+    def select(self, table, **kwargs):
+        key = table.lookup_key(**kwargs)
+        if key is not None:
+            live = self.natural.get((table, key))
+            if live is not None:
+                return live
+
+        obj = self.table(table).select(**kwargs)
+        return None if obj is None else self.merge(table, obj)
+
+    def select_many(self, table, positions, **kwargs):
+        """
+        Bulk select of rows by position, rows with a live object are not read again
+        """
+        found = list()
+        missing = list()
+        for pos in positions:
+            key = table.lookup_key(pos=pos, **kwargs)
+            live = self.natural.get((table, key)) if key is not None else None
+            if live is not None:
+                found.append(live)
+            else:
+                missing.append(pos)
+
+        if len(missing) > 0:
+            found += [self.merge(table, obj) for obj in self.table(table).select_many(positions=missing, **kwargs)]
+
+        return found
+
+    def flush(self):
+        """
+        Writes every queued object in a single transaction, returns the number of written rows
+        The queues are kept if the transaction fails, nothing is lost and the flush can be retried
+        """
+        written = 0
+        with self.conn:
+            for table in self.tables:
+                table_obj = self.table(table)
+                inserts = self.inserts[table]
+                updates = self.updates[table]
+
+                if len(inserts) > 0:
+                    self.conn.executemany(table.insert_row_sql(), map(table_obj.params, inserts.values()))
+                if len(updates) > 0:
+                    self.conn.executemany(table.update_sql, map(table_obj.params, updates.values()))
+
+                written += len(inserts) + len(updates)
+
+        for table in self.tables:
+            self.inserts[table].clear()
+            self.updates[table].clear()
+
+        if written > 0:
+            self.flushes += 1
+            logger.debug("Flushed %i rows", written)
+
+        return written
+
+    def clear(self):
+        """
+        Drops queued writes and forgets every object, used when the tables are emptied
+        """
+        for table in self.tables:
+            self.inserts[table].clear()
+            self.updates[table].clear()
+
+        self.next_ids.clear()
+        self.identity.clear()
+        self.natural.clear()
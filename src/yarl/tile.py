@@ -1,7 +1,13 @@
+from collections.abc import MutableMapping
 from yarl.block import BlockRegistry
 
 
 class Tile(object):
+    """
+    Detached tile value
+    """
+    __slots__ = ('block', 'meta')
+
     def __init__(self, block=None, meta=None):
         if block is None:
             self.block = BlockRegistry.instance().get('block.void')
@@ -22,3 +28,73 @@ class Tile(object):
             self.meta = {}
         else:
             self.meta = meta
+
+
+class TileView(object):
+    """
+    Flyweight view over a cell of a tile matrix
+    Reads and writes go straight to the matrix arrays
+    """
+    __slots__ = ('matrix', 'x', 'y')
+
+    def __init__(self, matrix, x, y):
+        self.matrix = matrix
+        self.x = x
+        self.y = y
+
+    @property
+    def block(self):
+        return self.matrix.get_block(self.x, self.y)
+
+    @block.setter
+    def block(self, block):
+        self.matrix.set_block(self.x, self.y, block, self.meta)
+
+    @property
+    def meta(self):
+        return TileMeta(self.matrix, self.x, self.y)
+
+    @meta.setter
+    def meta(self, meta):
+        self.matrix.set_meta(self.x, self.y, meta)
+
+    def render(self):
+        return self.block.render(self.meta)
+
+    def set_block(self, block, meta=None):
+        self.matrix.set_block(self.x, self.y, block, meta)
+
+
+class TileMeta(MutableMapping):
+    """
+    Live mapping over the metadata of a cell
+    Writes go through the matrix, so they are kept even if the cell had no metadata and mark the chunk dirty
+    """
+    __slots__ = ('matrix', 'x', 'y')
+
+    def __init__(self, matrix, x, y):
+        self.matrix = matrix
+        self.x = x
+        self.y = y
+
+    def __repr__(self):
+        return "TileMeta(%r)" % self.matrix.get_meta(self.x, self.y)
+
+    def __getitem__(self, key):
+        return self.matrix.get_meta(self.x, self.y)[key]
+
+    def __setitem__(self, key, value):
+        meta = dict(self.matrix.get_meta(self.x, self.y))
+        meta[key] = value
+        self.matrix.set_meta(self.x, self.y, meta)
+
+    def __delitem__(self, key):
+        meta = dict(self.matrix.get_meta(self.x, self.y))
+        del meta[key]
+        self.matrix.set_meta(self.x, self.y, meta)
+
+    def __iter__(self):
+        return iter(self.matrix.get_meta(self.x, self.y))
+
+    def __len__(self):
+        return len(self.matrix.get_meta(self.x, self.y))
@@ -18,12 +18,42 @@ def cantor_pairing(z1, z2):
     return (n1 + n2) * (n1 + n2 + 1) * 0.5 + n2
 
 
+def pack_key(x, y):
+    """
+    Packs two signed 32-bit coordinates into a single exact integer key
+
+    :param x: first coordinate
+    :param y: second coordinate
+    :return: 64-bit integer key
+    """
+    return ((x & 0xFFFFFFFF) << 32) | (y & 0xFFFFFFFF)
+
+
+def unpack_key(key):
+    """
+    Inverse of `pack_key`
+
+    :param key: integer key
+    :return: (x, y) tuple of signed coordinates
+    """
+    x, y = key >> 32, key & 0xFFFFFFFF
+    if x & 0x80000000:
+        x -= 0x100000000
+    if y & 0x80000000:
+        y -= 0x100000000
+
+    return x, y
+
+
 def dump_vec2(vec2d):
     return ("%i;%i" % (vec2d.x, vec2d.y)).encode("ascii")
 
 
 def load_vec2(data):
-    x, y = map(float, data.decode('ascii').split(";"))
+    # Not imported with the module, the asset build uses these utilities without sfml
+    from sfml import sf
+
+    x, y = map(int, data.decode('ascii').split(";"))
     return sf.Vector2(x, y)
 
 
@@ -85,10 +115,13 @@ def apply_seq(seq, func_name, *args, **kwargs):
 base_dir = compose(realpath, dirname)
 
 
-def hash_file(path):
+def hash_file(path, block_size=64 * 1024):
     checksum = hashlib.sha1()
     with open(path, mode='rb') as fd:
-        checksum.update(fd.read(128))
+        block = fd.read(block_size)
+        while len(block) > 0:
+            checksum.update(block)
+            block = fd.read(block_size)
 
     return checksum.hexdigest()
 
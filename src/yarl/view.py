@@ -1,4 +1,6 @@
 from sfml import sf
+from yarl.block import BlockRegistry
+import numpy as np
 
 
 class TileAtlas(object):
@@ -9,6 +11,8 @@ class TileAtlas(object):
         self.size = size
         self.order = order
         self.next_id = 0
+        # Source textures of the icons, kept in the pool while this atlas is in use
+        self.sources = set()
 
     def build(self, registry):
         self.render = sf.RenderTexture(self.size.x * self.order, self.size.y * self.order)
@@ -20,6 +24,7 @@ class TileAtlas(object):
 
         self.render.display()
         self.texture = self.render.texture
+        self.tex_pool.pin(self.sources)
 
     def add_icon(self, name):
         x, y, path = name.split(':')
@@ -29,6 +34,7 @@ class TileAtlas(object):
                             self.size)
 
         tex = self.tex_pool.get(path)
+        self.sources.add(path)
         spr = sf.Sprite(tex, rect)
         spr.position = self.get_pos(self.next_id)
 
@@ -49,11 +55,50 @@ class TileAtlas(object):
         pos = self.get_pos(cell)
         return sf.Rectangle(pos, self.size)
 
+    @property
+    def tile_size(self):
+        return np.array((self.size.x, self.size.y), dtype=np.float32)
+
+    def get_uv(self, cells):
+        """
+        Vectorized `get_pos`, returns the top-left texture coordinates of each cell
+        """
+        return np.stack((cells % self.order, cells // self.order), axis=1).astype(np.float32) * self.tile_size
+
+    def compile(self, registry):
+        """
+        Builds the render table of the registered blocks, icons must have been added by `build`
+        """
+        return RenderTable(self, registry)
+
     def tex(self):
         return self.texture
 
 
+class RenderTable(object):
+    """
+    Precomputed texture coordinates of each block variant, indexed by block id and variant index
+    Blocks flagged as dynamic are rendered through their `render` callback instead
+    """
+
+    def __init__(self, atlas, registry):
+        self.blocks, cells, self.dynamic = registry.compile_icons()
+        self.variants = [{name: idx for idx, name in enumerate(block.icons)} if block is not None else {}
+                         for block in self.blocks]
+
+        uv = atlas.get_uv(cells.ravel())
+        quads = uv[:, None, :] + TileQuad.corners * atlas.tile_size
+        self.tex_coords = quads.reshape(cells.shape + (4, 2))
+
+    def variant(self, block_id, meta):
+        block = self.blocks[block_id]
+        return self.variants[block_id].get(block.variant(meta), 0)
+
+
 class TileQuad(object):
+    # Corners of a quad in vertex order
+    corners = np.array([(0, 0), (1, 0), (1, 1), (0, 1)], dtype=np.float32)
+
     def __init__(self, vertices, index, atlas):
         self.atlas = atlas
         self.index = index
@@ -82,35 +127,123 @@ class TileQuad(object):
 
 
 class TileMap(sf.Drawable):
+    """
+    Renders a window of a level
+    Quads are laid out as a ring buffer in world space, a tile at (x, y) always uses the slot
+    (x mod width, y mod height) so scrolling only rewrites the tiles that come into view
+    """
+
     def __init__(self, size, atlas):
         sf.Drawable.__init__(self)
         self.vertices = sf.VertexArray()
         self.transform = sf.Transform()
         self.size = size
         self.atlas = atlas
+        self.table = None
+        self.floor = None
+        self.origin = None
+        self.dirty = set()
+        self.dirty_rects = list()
+
+    def invalidate(self, pos):
+        """
+        Marks a tile as changed, called by the observed level
+        """
+        self.dirty.add((pos.x, pos.y))
+
+    def invalidate_rect(self, pos, size):
+        self.dirty_rects.append((pos, size))
 
     def update(self, floor, center):
-        self.vertices.resize(self.size.x * self.size.y * 4)
-        self.vertices.primitive_type = sf.PrimitiveType.QUADS
+        if self.table is None:
+            self.table = self.atlas.compile(BlockRegistry.instance())
 
         origin = center - (self.size // 2)
-        for y in range(0, self.size.y):
-            for x in range(self.size.x):
-                pos = sf.Vector2(x, y)
-                # Compute vertex slice
-                base_idx = (pos.x + pos.y * self.size.x) * 4
-
-                # Compute tile position
-                tpos = origin + pos
-                # Fetch tile & block
-                tile = floor.get_tile(tpos)
-                block = tile.block
-
-                # Render tile
-                quad = TileQuad(self.vertices, base_idx, self.atlas)
-                quad.set_position(pos)
-                # quad.set_icon(0)
-                block.render(tile.meta, quad)
+        floor.pin_rect(origin, self.size)
+        floor.prefetch_around(center)
+
+        if floor is not self.floor:
+            if self.floor is not None:
+                self.floor.remove_observer(self)
+            floor.add_observer(self)
+            self.floor = floor
+            self.origin = None
+
+        if self.origin is None or abs(origin.x - self.origin.x) >= self.size.x \
+                or abs(origin.y - self.origin.y) >= self.size.y:
+            self.redraw(origin)
+        else:
+            self.scroll(origin)
+
+        self.origin = origin
+        self.transform = sf.Transform()
+        self.transform.translate(sf.Vector2(-origin.x * self.atlas.size.x,
+                                            -origin.y * self.atlas.size.y))
+
+    def redraw(self, origin):
+        self.vertices.resize(self.size.x * self.size.y * 4)
+        self.vertices.primitive_type = sf.PrimitiveType.QUADS
+        self.dirty.clear()
+        del self.dirty_rects[:]
+        self.write_region(origin, self.size)
+
+    def scroll(self, origin):
+        delta = origin - self.origin
+
+        # Columns then rows exposed by the move, the corner is written twice
+        if delta.x > 0:
+            self.write_region(sf.Vector2(self.origin.x + self.size.x, origin.y),
+                              sf.Vector2(delta.x, self.size.y))
+        elif delta.x < 0:
+            self.write_region(origin, sf.Vector2(-delta.x, self.size.y))
+
+        if delta.y > 0:
+            self.write_region(sf.Vector2(origin.x, self.origin.y + self.size.y),
+                              sf.Vector2(self.size.x, delta.y))
+        elif delta.y < 0:
+            self.write_region(origin, sf.Vector2(self.size.x, -delta.y))
+
+        dirty, self.dirty = self.dirty, set()
+        for x, y in dirty:
+            if origin.x <= x < origin.x + self.size.x and origin.y <= y < origin.y + self.size.y:
+                self.write_region(sf.Vector2(x, y), sf.Vector2(1, 1))
+
+        dirty_rects, self.dirty_rects = self.dirty_rects, list()
+        for pos, size in dirty_rects:
+            p1 = sf.Vector2(max(pos.x, origin.x), max(pos.y, origin.y))
+            p2 = sf.Vector2(min(pos.x + size.x, origin.x + self.size.x), min(pos.y + size.y, origin.y + self.size.y))
+            if p1.x < p2.x and p1.y < p2.y:
+                self.write_region(p1, p2 - p1)
+
+    def write_region(self, pos, size):
+        """
+        Rewrites the quads of a rectangle of tiles
+        """
+        blocks = self.floor.get_region(pos, size)
+        meta = self.floor.get_region_meta(pos, size)
+
+        # Only tiles with metadata can use another variant than the first
+        variants = np.zeros(blocks.shape, dtype=np.intp)
+        for (x, y), data in meta.items():
+            variants[x, y] = self.table.variant(blocks[x, y], data)
+
+        xs, ys = np.mgrid[pos.x:pos.x + size.x, pos.y:pos.y + size.y]
+        slots = (ys % self.size.y) * self.size.x + (xs % self.size.x)
+
+        tiles = np.stack((xs.ravel(), ys.ravel()), axis=1).astype(np.float32)
+        positions = ((tiles[:, None, :] + TileQuad.corners) * self.atlas.tile_size).tolist()
+        tex_coords = self.table.tex_coords[blocks.ravel(), variants.ravel()].tolist()
+
+        for slot, quad_pos, quad_tex in zip(slots.ravel().tolist(), positions, tex_coords):
+            base_idx = slot * 4
+            for idx in range(4):
+                self.vertices[base_idx + idx] = sf.Vertex(position=sf.Vector2(*quad_pos[idx]),
+                                                          tex_coords=sf.Vector2(*quad_tex[idx]))
+
+        for x, y in zip(*np.nonzero(self.table.dynamic[blocks])):
+            block = self.table.blocks[blocks[x, y]]
+            quad = TileQuad(self.vertices, slots[x, y] * 4, self.atlas)
+            block.render(meta.get((x, y), {}), quad)
 
     def draw(self, target, states):
         # sf.TransformableDrawable.draw(self, target, states)